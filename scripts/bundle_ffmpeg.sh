@@ -1,6 +1,6 @@
 #!/bin/bash
 
-# Script to download statically linked FFmpeg binaries
+# Script to download statically linked FFmpeg binaries (ffmpeg and ffprobe)
 # Usage: ./download_ffmpeg.sh <platform> <destination_path>
 
 set -e  # Exit on error
@@ -34,6 +34,9 @@ download_ffmpeg() {
         mac)
             FFMPEG_URL="https://evermeet.cx/ffmpeg/get/zip"
             FFMPEG_ZIP="ffmpeg.zip"
+            # evermeet.cx builds each executable separately
+            FFPROBE_URL="https://evermeet.cx/ffmpeg/get/ffprobe/zip"
+            FFPROBE_ZIP="ffprobe.zip"
             ;;
 
         win)
@@ -54,6 +57,7 @@ download_ffmpeg() {
         wget -q --show-progress -O "$OUTPUT_DIR/$FFMPEG_TAR" "$FFMPEG_URL"
         tar -xf "$OUTPUT_DIR/$FFMPEG_TAR" -C "$OUTPUT_DIR"
         mv "$OUTPUT_DIR"/*/ffmpeg "$OUTPUT_DIR/ffmpeg"
+        mv "$OUTPUT_DIR"/ffmpeg-*/ffprobe "$OUTPUT_DIR/ffprobe"
         rm -rf "$OUTPUT_DIR/$FFMPEG_TAR" "$OUTPUT_DIR/"ffmpeg-*
 
     elif [[ "$PLATFORM" == "mac" ]]; then
@@ -61,6 +65,9 @@ download_ffmpeg() {
         unzip -q "$OUTPUT_DIR/$FFMPEG_ZIP" -d "$OUTPUT_DIR"
         mv "$OUTPUT_DIR/ffmpeg" "$OUTPUT_DIR/ffmpeg"
         rm -rf "$OUTPUT_DIR/$FFMPEG_ZIP"
+        wget -q --show-progress -O "$OUTPUT_DIR/$FFPROBE_ZIP" "$FFPROBE_URL"
+        unzip -q "$OUTPUT_DIR/$FFPROBE_ZIP" -d "$OUTPUT_DIR"
+        rm -rf "$OUTPUT_DIR/$FFPROBE_ZIP"
 
     elif [[ "$PLATFORM" == "win" ]]; then
         wget -q --show-progress -O "$OUTPUT_DIR/$FFMPEG_ZIP" "$FFMPEG_URL"
@@ -73,22 +80,31 @@ download_ffmpeg() {
             exit 1
         fi
 
-        # Move the executable to the destination path
+        FFPROBE_EXEC=$(find "$OUTPUT_DIR" -type f -name "ffprobe.exe" | head -n 1)
+        if [[ -z "$FFPROBE_EXEC" ]]; then
+            echo "Error: ffprobe.exe not found in the extracted files."
+            exit 1
+        fi
+
+        # Move the executables to the destination path
         mv "$FF_EXEC" "$OUTPUT_DIR/ffmpeg.exe"
+        mv "$FFPROBE_EXEC" "$OUTPUT_DIR/ffprobe.exe"
         rm -rf "$OUTPUT_DIR/$FFMPEG_ZIP" "$OUTPUT_DIR/ffmpeg-*"
     fi
 
-    echo "FFmpeg binary downloaded and placed in $OUTPUT_DIR."
+    echo "FFmpeg binaries downloaded and placed in $OUTPUT_DIR."
 }
 
 # Run the function
 download_ffmpeg "$PLATFORM" "$DEST_PATH"
 
-# Verify the binary
-echo "Verifying FFmpeg binary..."
-if [[ -f "$DEST_PATH/ffmpeg" ]]; then
-    echo "FFmpeg binary successfully downloaded to $DEST_PATH."
-else
-    echo "Error: FFmpeg binary not found in $DEST_PATH."
-    exit 1
-fi
+# Verify the binaries
+echo "Verifying FFmpeg binaries..."
+for BINARY in ffmpeg ffprobe; do
+    if [[ -f "$DEST_PATH/$BINARY" || -f "$DEST_PATH/$BINARY.exe" ]]; then
+        echo "$BINARY successfully downloaded to $DEST_PATH."
+    else
+        echo "Error: $BINARY binary not found in $DEST_PATH."
+        exit 1
+    fi
+done
@@ -0,0 +1,179 @@
+"""Local stand-in for the OpenAI Files and Batch endpoints, to run
+`generateSummaries --batch` without network access.
+
+Usage:
+    python benchmarks/batch_server.py [--port 8790] [--delay 2] [--fail_every 0]
+
+then point the client at it:
+    OPENAI_BASE_URL=http://127.0.0.1:8790/v1 python main.py generateSummaries input.json output.json openai test --batch --batch_poll_interval 1
+
+Implemented: POST /v1/files, GET /v1/files/{id}/content, DELETE /v1/files/{id},
+POST /v1/batches, GET /v1/batches/{id} and POST /v1/batches/{id}/cancel. A batch
+is answered `delay` seconds after it is created, every request by the stub
+client (see stub_client.py), so results are deterministic; with --fail_every N
+every Nth request fails and lands in the error file instead.
+"""
+import argparse
+import email.parser
+import email.policy
+import json
+import os
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import videoObjects
+from stub_client import StubCompletions
+
+
+class BatchServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port = 0, delay = 0.0, fail_every = 0):
+        super().__init__(("127.0.0.1", port), BatchHandler)
+        self.delay = delay
+        self.fail_every = fail_every
+        self.files = {}
+        self.batches = {}
+        self.created_files = 0
+        self.completions = StubCompletions()
+        self.lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}/v1"
+
+    def add_file(self, filename: str, purpose: str, content: bytes) -> dict:
+        with self.lock:
+            self.created_files += 1
+            file_id = f"file-{self.created_files}"
+            self.files[file_id] = {
+                "meta": {"id": file_id, "object": "file", "bytes": len(content), "created_at": int(time.time()), "filename": filename, "purpose": purpose, "status": "processed"},
+                "content": content
+            }
+            return self.files[file_id]["meta"]
+
+    def create_batch(self, request: dict) -> dict:
+        with self.lock:
+            batch_id = f"batch_{len(self.batches) + 1}"
+            batch = {
+                "id": batch_id, "object": "batch", "endpoint": request["endpoint"], "errors": None,
+                "input_file_id": request["input_file_id"], "completion_window": request["completion_window"],
+                "status": "validating", "output_file_id": None, "error_file_id": None, "created_at": int(time.time()),
+                "request_counts": {"total": 0, "completed": 0, "failed": 0}, "metadata": request.get("metadata")
+            }
+            self.batches[batch_id] = batch
+        threading.Timer(self.delay, self.run_batch, (batch_id,)).start()
+        return batch
+
+    def run_batch(self, batch_id: str) -> None:
+        batch = self.batches[batch_id]
+        if batch["status"] == "cancelled":
+            return
+        batch["status"] = "in_progress"
+        lines = self.files[batch["input_file_id"]]["content"].decode().splitlines()
+        batch["request_counts"]["total"] = len(lines)
+        output, errors = [], []
+        for n, line in enumerate(lines, 1):
+            request = json.loads(line)
+            result = {"id": f"batch_req_{n}", "custom_id": request["custom_id"], "response": None, "error": None}
+            if self.fail_every and n % self.fail_every == 0:
+                result["error"] = {"code": "server_error", "message": "Stand-in failure."}
+                errors.append(result)
+                batch["request_counts"]["failed"] += 1
+                continue
+            result["response"] = {"status_code": 200, "request_id": f"req_{n}", "body": self.complete(request["body"])}
+            output.append(result)
+            batch["request_counts"]["completed"] += 1
+        if output:
+            batch["output_file_id"] = self.add_file(f"{batch_id}_output.jsonl", "batch_output", "".join(json.dumps(result) + "\n" for result in output).encode())["id"]
+        if errors:
+            batch["error_file_id"] = self.add_file(f"{batch_id}_errors.jsonl", "batch_output", "".join(json.dumps(result) + "\n" for result in errors).encode())["id"]
+        batch["status"] = "completed"
+        batch["completed_at"] = int(time.time())
+
+    def complete(self, body: dict) -> dict:
+        response_format = body.get("response_format")
+        if response_format:
+            response = self.completions._parse(getattr(videoObjects, response_format["json_schema"]["name"]), body["messages"])
+        else:
+            response = self.completions._create(body["messages"])
+        usage = response.usage
+        return {
+            "id": "chatcmpl-stand-in", "object": "chat.completion", "created": int(time.time()), "model": body["model"],
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": response.choices[0].message.content}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": usage.prompt_tokens, "completion_tokens": usage.completion_tokens, "total_tokens": usage.total_tokens}
+        }
+
+
+class BatchHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status: int, body) -> None:
+        data = body if isinstance(body, bytes) else json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/octet-stream" if isinstance(body, bytes) else "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def do_POST(self):
+        server = self.server
+        if self.path == "/v1/files":
+            form = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode() + self.body())
+            fields = {part.get_param("name", header="content-disposition"): part for part in form.iter_parts()}
+            upload = fields["file"]
+            self.reply(200, server.add_file(upload.get_filename() or "input.jsonl", fields["purpose"].get_content().strip(), upload.get_payload(decode=True)))
+        elif self.path == "/v1/batches":
+            self.reply(200, server.create_batch(json.loads(self.body())))
+        elif match := re.fullmatch(r"/v1/batches/([^/]+)/cancel", self.path):
+            batch = server.batches.get(match.group(1))
+            if batch is None:
+                return self.reply(404, {"error": {"message": "No such batch."}})
+            if batch["status"] not in ("completed", "failed", "expired"):
+                batch["status"] = "cancelled"
+            self.reply(200, batch)
+        else:
+            self.reply(404, {"error": {"message": f"Unknown path {self.path}"}})
+
+    def do_GET(self):
+        server = self.server
+        if match := re.fullmatch(r"/v1/batches/([^/]+)", self.path):
+            batch = server.batches.get(match.group(1))
+            self.reply(200, batch) if batch else self.reply(404, {"error": {"message": "No such batch."}})
+        elif match := re.fullmatch(r"/v1/files/([^/]+)/content", self.path):
+            file = server.files.get(match.group(1))
+            self.reply(200, file["content"]) if file else self.reply(404, {"error": {"message": "No such file."}})
+        else:
+            self.reply(404, {"error": {"message": f"Unknown path {self.path}"}})
+
+    def do_DELETE(self):
+        match = re.fullmatch(r"/v1/files/([^/]+)", self.path)
+        with self.server.lock:
+            file = self.server.files.pop(match.group(1), None) if match else None
+        if file is None:
+            return self.reply(404, {"error": {"message": "No such file."}})
+        self.reply(200, {"id": file["meta"]["id"], "object": "file", "deleted": True})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8790)
+    parser.add_argument("--delay", type=float, default=2, help="Seconds before a batch is answered.")
+    parser.add_argument("--fail_every", type=int, default=0, help="Fail every Nth request of a batch.")
+    args = parser.parse_args()
+    server = BatchServer(args.port, args.delay, args.fail_every)
+    print(f"Serving the batch endpoints at {server.url}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+"""Compares the frame encode profiles on payload size, image tokens and window sizing.
+
+Usage:
+    python benchmarks/bench_encode_profiles.py [video ...] [--seconds 120] [--window 50] [--max_window_tokens 16000]
+
+Without video paths a clip with a cut every 40 seconds is synthesized. For each
+profile the encode time, bytes per frame, image tokens per frame and the
+resulting frames per request window are printed.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+from scenedetect import HashDetector
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tasks import SCENE_THRESHOLD, FRAME_INTERVAL
+from utils import iter_frame_windows, ENCODE_PROFILES
+from media import synthesize_clip
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("videos", nargs="*", help="Videos to encode; a synthetic clip is used if omitted.")
+    parser.add_argument("--seconds", type=float, default=120, help="Length of the synthetic clip.")
+    parser.add_argument("--window", type=int, default=50, help="Frames per request window cap (LLM_IMG_LIMIT).")
+    parser.add_argument("--max_window_mb", type=int, default=32, help="Request payload cap per window, in MB.")
+    parser.add_argument("--max_window_tokens", type=int, default=16000, help="Image token cap per window.")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        videos = args.videos
+        if not videos:
+            clip = os.path.join(tmp, "profiles.mp4")
+            print(f"Synthesizing a {args.seconds:.0f}s clip...")
+            synthesize_clip(clip, args.seconds, 30, cut_every=40)
+            videos = [clip]
+
+        for video in videos:
+            print(os.path.basename(video))
+            for profile in ENCODE_PROFILES.values():
+                start = time.perf_counter()
+                windows = list(iter_frame_windows(video, HashDetector(threshold=SCENE_THRESHOLD), args.window, FRAME_INTERVAL, profile, args.max_window_mb * 1024 * 1024, args.max_window_tokens))
+                elapsed = time.perf_counter() - start
+                frames = sum(len(window.frames) for window in windows)
+                payload = sum(profile.payload_bytes(frame) for window in windows for frame in window.frames)
+                print(f"  {profile.name:>9}: {elapsed:7.2f}s  {payload / max(frames, 1) / 1024:7.1f} KiB/frame  "
+                      f"{profile.image_tokens:5d} tokens/frame  {len(windows)} windows, {frames / max(len(windows), 1):.1f} frames each  "
+                      f"{payload / 1024 / 1024:.1f} MiB total")
+
+
+if __name__ == "__main__":
+    main()
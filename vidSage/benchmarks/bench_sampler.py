@@ -0,0 +1,78 @@
+"""Compares the sequential frame sampler against the old seek-per-sample one.
+
+Usage:
+    python benchmarks/bench_sampler.py [video ...] [--minutes 10] [--gop 250]
+
+Without video paths a long-GOP H.264 clip is synthesized with ffmpeg (or with
+OpenCV's mp4v writer when ffmpeg is not on PATH).
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import cv2
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils import extract_frames_fixed
+from media import synthesize_clip
+
+
+def extract_frames_seek(video_path, interval=1):
+    """The previous implementation: seek to every sample with CAP_PROP_POS_FRAMES."""
+    video = cv2.VideoCapture(video_path)
+    frames = []
+    fps = video.get(cv2.CAP_PROP_FPS)
+    frame_interval = int(fps) * interval
+
+    total_frames = int(video.get(cv2.CAP_PROP_FRAME_COUNT))
+    for i in range(0, total_frames, frame_interval):
+        video.set(cv2.CAP_PROP_POS_FRAMES, i)
+        ret, frame = video.read()
+        if ret:
+            frames.append(frame)
+
+    video.release()
+    return frames
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return time.perf_counter() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("videos", nargs="*", help="Videos to sample; a synthetic clip is used if omitted.")
+    parser.add_argument("--minutes", type=float, default=10, help="Length of the synthetic clip.")
+    parser.add_argument("--fps", type=float, default=29.97, help="Frame rate of the synthetic clip.")
+    parser.add_argument("--gop", type=int, default=250, help="Keyframe interval of the synthetic clip.")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        videos = args.videos
+        if not videos:
+            clip = os.path.join(tmp, "long_gop.mp4")
+            print(f"Synthesizing {args.minutes} min clip at {args.fps} fps, GOP {args.gop}...")
+            synthesize_clip(clip, args.minutes * 60, args.fps, gop=args.gop)
+            videos = [clip]
+
+        for video in videos:
+            capture = cv2.VideoCapture(video)
+            fps = capture.get(cv2.CAP_PROP_FPS)
+            duration = capture.get(cv2.CAP_PROP_FRAME_COUNT) / fps if fps else 0
+            capture.release()
+
+            seek_time, seek_frames = timed(extract_frames_seek, video)
+            seq_time, seq_frames = timed(extract_frames_fixed, video)
+            print(f"{os.path.basename(video)} ({duration:.0f}s @ {fps:.3f} fps)")
+            print(f"  seek:       {seek_time:8.2f}s  {len(seek_frames)} frames")
+            print(f"  sequential: {seq_time:8.2f}s  {len(seq_frames)} frames")
+            print(f"  speedup:    {seek_time / seq_time:8.2f}x")
+
+
+if __name__ == "__main__":
+    main()
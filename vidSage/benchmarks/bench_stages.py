@@ -0,0 +1,167 @@
+"""Runs the whole pipeline offline and reports the cost of each stage.
+
+Usage:
+    python benchmarks/bench_stages.py [--scale 1] [--latency 0.2] [--max_in_flight 1] [--workers 1] [--clips eager] [--json results.json]
+
+A corpus of synthetic clips of varied length, resolution, frame rate and cut
+density is generated, then generate_summaries, generate_storyline and
+generate_video run in turn against the stub client, which sleeps `latency`
+seconds per request. Each stage runs in a fresh process, so its wall time, CPU
+time and peak RSS are its own; the peak RSS of the ffmpeg and worker processes it
+starts is reported separately. Uploaded bytes and request counts come from the
+stub client. With --json the numbers are also saved, to compare runs.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from media import synthesize_clip
+
+# name, seconds, width, height, fps, seconds between cuts (None: one long scene)
+CORPUS = [
+    ("short_720p", 20, 1280, 720, 30, 5),
+    ("long_480p", 60, 854, 480, 25, 20),
+    ("hfr_1080p", 15, 1920, 1080, 60, None),
+    ("dense_360p", 30, 640, 360, 24, 2),
+]
+
+
+def peak_rss_mb(who) -> float:
+    if resource is None:
+        return None
+    peak = resource.getrusage(who).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def cpu_seconds() -> float:
+    if resource is None:
+        return time.process_time()
+    return sum(usage.ru_utime + usage.ru_stime for usage in (resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)))
+
+
+def scripted_story_client(client, summaries_path: str, scenes = 8):
+    """Makes the stub answer storyline requests with the first segment of each
+    summary in turn, so generate_video has real ranges to render."""
+    with open(summaries_path) as f:
+        summaries = json.load(f)
+
+    def story(messages):
+        picked = []
+        for i in range(scenes):
+            summary = summaries[i % len(summaries)]
+            segment = summary["segments"][(i // len(summaries)) % len(summary["segments"])]
+            picked.append({"story": segment["description"], "file_path": summary["file"]["absolutePath"], "start": int(segment["startTimeSec"]), "end": max(int(segment["endTimeSec"]), int(segment["startTimeSec"]) + 1)})
+        return {"title": "Benchmark story", "whole_story": "", "scenes": picked}
+
+    client.completions.story = story
+    return client
+
+
+def run_stage(stage: str, workdir: str, paths: dict, options: dict) -> dict:
+    """Runs one stage in this (fresh) process and measures it."""
+    from stub_client import StubClient, AsyncStubClient
+    import tasks
+    import tasks_async
+
+    # the tasks keep their temporary files under ./tmp
+    os.chdir(workdir)
+    # importing the pipeline runs short-lived helper processes; only children
+    # bigger than those are attributed to the stage
+    import_children_rss = peak_rss_mb(resource.RUSAGE_CHILDREN) if resource else None
+    client = None
+    start_cpu = cpu_seconds()
+    start = time.perf_counter()
+    if stage == "summaries":
+        if options["max_in_flight"] > 1:
+            client = AsyncStubClient(options["latency"])
+            tasks_async.generate_summaries_async(paths["input"], paths["summaries"], client, options["max_in_flight"], workers=options["workers"])
+        else:
+            client = StubClient(options["latency"])
+            tasks.generate_summaries(paths["input"], paths["summaries"], client, workers=options["workers"])
+    elif stage == "storyline":
+        with open(paths["summaries"]) as f:
+            summaries = json.load(f)
+        with open(paths["story_input"], "w") as f:
+            json.dump({"taskId": "bench", "summaries": summaries, "prompt": "", "duration": 1}, f)
+        client = scripted_story_client(StubClient(options["latency"]), paths["summaries"])
+        tasks.generate_storyline(paths["story_input"], paths["storyline"], client, clips=options["clips"])
+    else:
+        with open(paths["storyline"]) as f:
+            storyline = json.load(f)
+        with open(paths["video_input"], "w") as f:
+            json.dump({"taskId": "bench", "segments": storyline}, f)
+        tasks.generate_video(paths["video_input"], paths["video"], not options["reencode"])
+    elapsed = time.perf_counter() - start
+
+    requests = client.completions.requests if client else []
+    children_rss = peak_rss_mb(resource.RUSAGE_CHILDREN) if resource else None
+    return {
+        "stage": stage,
+        "seconds": round(elapsed, 3),
+        "cpuSeconds": round(cpu_seconds() - start_cpu, 3),
+        "peakRssMb": peak_rss_mb(resource.RUSAGE_SELF) if resource else None,
+        "childPeakRssMb": children_rss if resource and children_rss > import_children_rss else None,
+        "requests": len(requests),
+        "uploadedBytes": sum(request["bytes"] for request in requests),
+        "images": sum(request["images"] for request in requests),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scale", type=float, default=1, help="Multiplies the length of every synthetic clip.")
+    parser.add_argument("--latency", type=float, default=0.2, help="Seconds the stub client takes per request.")
+    parser.add_argument("--max_in_flight", type=int, default=1, help="Concurrent LLM requests; above 1 the async summarizer is used.")
+    parser.add_argument("--workers", type=int, default=1, help="Worker processes for decoding and encoding.")
+    parser.add_argument("--clips", choices=["eager", "lazy"], help="Also cut per-scene clips in the storyline stage (lazy only lists them, to be cut on demand).")
+    parser.add_argument("--reencode", action="store_true", help="Render the final video by re-encoding instead of stream copying.")
+    parser.add_argument("--json", help="Also write the results to this file.")
+    args = parser.parse_args()
+    options = vars(args)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        files = []
+        for name, seconds, width, height, fps, cut_every in CORPUS:
+            path = os.path.join(tmp, f"{name}.mp4")
+            print(f"Synthesizing {name}: {seconds * args.scale:.0f}s {width}x{height} at {fps} fps" + (f", a cut every {cut_every}s" if cut_every else ""))
+            synthesize_clip(path, seconds * args.scale, fps, width, height, gop=fps * 5, cut_every=cut_every)
+            files.append({"absolutePath": path, "name": os.path.basename(path)})
+
+        paths = {name: os.path.join(tmp, f"{name}{ext}") for name, ext in [
+            ("input", ".json"), ("summaries", ".json"), ("story_input", ".json"), ("storyline", ".json"), ("video_input", ".json"), ("video", ".mp4")
+        ]}
+        with open(paths["input"], "w") as f:
+            json.dump({"taskId": "bench", "files": files}, f)
+
+        results = []
+        for stage in ("summaries", "storyline", "video"):
+            # a fresh process per stage so peak RSS is not carried over from the last one
+            with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context("spawn")) as pool:
+                result = pool.submit(run_stage, stage, tmp, paths, options).result()
+            results.append(result)
+            rss = f"{result['peakRssMb']:7.1f} MB" if result["peakRssMb"] is not None else "    n/a"
+            rss += f"  children {result['childPeakRssMb']:7.1f} MB" if result["childPeakRssMb"] is not None else "  children       - MB"
+            print(f"{stage:>10}: {result['seconds']:8.2f}s wall  {result['cpuSeconds']:8.2f}s cpu  peak RSS {rss}  "
+                  f"{result['requests']:4d} requests  {result['uploadedBytes'] / 1024 / 1024:7.2f} MiB uploaded")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"options": options, "corpus": CORPUS, "stages": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""Measures cold-start time of each main.py subcommand.
+
+Usage:
+    python benchmarks/bench_startup.py [--repeat 10] [--binary dist/main]
+
+Every subcommand is run in a fresh process with arguments that make it return
+as early as possible (missing input files, `--help`), so the time measured is
+interpreter start-up plus imports. By default `python main.py` is run; pass
+--binary to time a PyInstaller bundle instead. The median and best wall time of
+each command are printed, followed by the slowest modules of a
+`python -X importtime` run of the slowest command.
+"""
+import argparse
+import os
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+VIDSAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MAIN = os.path.join(VIDSAGE_DIR, "main.py")
+
+
+def commands(tmp: str) -> dict:
+    missing = os.path.join(tmp, "missing.json")
+    out = os.path.join(tmp, "out")
+    return {
+        "help": ["--help"],
+        "cleanUp": ["cleanUp"],
+        "getDebugInfo": ["getDebugInfo"],
+        "invalidateCache": ["invalidateCache", "--cache_dir", tmp],
+        "clipVideo": ["clipVideo", missing, out + ".mp4", "0", "1"],
+        "generateVideo": ["generateVideo", missing, out + ".mp4"],
+        "generateSummaries": ["generateSummaries", missing, out + ".json", "openai", "sk-none", "--cache_dir", tmp],
+        "generateStoryline": ["generateStoryline", missing, out + ".json", "openai", "sk-none"],
+    }
+
+
+def run(command: list, cwd: str) -> float:
+    start = time.perf_counter()
+    subprocess.run(command, cwd=cwd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+
+def slowest_imports(args: list, cwd: str, count = 10) -> list:
+    """Cumulative import times of the top-level modules, slowest first."""
+    result = subprocess.run([sys.executable, "-X", "importtime", MAIN] + args, cwd=cwd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    times = []
+    for line in result.stderr.splitlines():
+        match = re.match(r"import time:\s+\d+ \|\s+(\d+) \|( *)(\S+)", line)
+        # only modules imported directly by main.py or its lazy imports
+        if match and len(match.group(2)) == 1:
+            times.append((int(match.group(1)) / 1e6, match.group(3)))
+    return sorted(times, reverse=True)[:count]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=10, help="Runs per command.")
+    parser.add_argument("--binary", help="Time this executable instead of `python main.py`.")
+    args = parser.parse_args()
+
+    launcher = [os.path.abspath(args.binary)] if args.binary else [sys.executable, MAIN]
+    with tempfile.TemporaryDirectory() as tmp:
+        results = {}
+        for name, command in commands(tmp).items():
+            # the first run warms the file system cache and is not counted
+            run(launcher + command, tmp)
+            times = [run(launcher + command, tmp) for _ in range(args.repeat)]
+            results[name] = times
+            print(f"{name:>18}: median {statistics.median(times) * 1000:7.1f} ms  best {min(times) * 1000:7.1f} ms")
+
+        if not args.binary:
+            slowest = max(results, key=lambda name: statistics.median(results[name]))
+            print(f"\nSlowest imports for {slowest}:")
+            for seconds, module in slowest_imports(commands(tmp)[slowest], tmp):
+                print(f"  {seconds * 1000:7.1f} ms  {module}")
+
+
+if __name__ == "__main__":
+    main()
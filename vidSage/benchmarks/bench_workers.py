@@ -0,0 +1,53 @@
+"""Measures how the CPU stage of generate_summaries scales with worker processes.
+
+Usage:
+    python benchmarks/bench_workers.py [video ...] [--files 8] [--workers 1 2 4 8]
+
+Runs tasks.prepare_windows (decode, scene detection, resize, JPEG encoding) over
+the batch with each worker count and reports the speedup over the first count.
+Without video paths, synthetic 1080p clips are generated.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tasks import prepare_windows
+from media import synthesize_clip
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("videos", nargs="*", help="Videos to prepare; synthetic clips are used if omitted.")
+    parser.add_argument("--files", type=int, default=8, help="Number of synthetic clips.")
+    parser.add_argument("--seconds", type=float, default=60, help="Length of each synthetic clip.")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8], help="Worker counts to try.")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        videos = args.videos
+        if not videos:
+            print(f"Synthesizing {args.files} clips of {args.seconds}s...")
+            videos = []
+            for i in range(args.files):
+                clip = os.path.join(tmp, f"clip_{i}.mp4")
+                synthesize_clip(clip, args.seconds, 30, 1920, 1080, cut_every=15, seed=i)
+                videos.append(clip)
+
+        baseline = None
+        for workers in args.workers:
+            start = time.perf_counter()
+            with ProcessPoolExecutor(workers) as pool:
+                futures = [pool.submit(prepare_windows, video, os.path.join(tmp, f"windows_{workers}", str(i))) for i, video in enumerate(videos)]
+                windows = sum(len(future.result()) for future in futures)
+            elapsed = time.perf_counter() - start
+            baseline = baseline or elapsed
+            print(f"{workers:3d} workers: {elapsed:8.2f}s  {windows} windows  speedup {baseline / elapsed:5.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+"""Runs the chained and map-reduce description modes side by side against a stub client.
+
+Usage:
+    python benchmarks/compare_describe_modes.py [video ...] [--latency 1.5] [--max_in_flight 8] [--out DIR]
+
+Without video paths a clip with long scenes is synthesized. For each mode the
+wall time and request count are printed, and the summaries are written to
+DIR/<mode>.json so the two outputs can be diffed, or the run repeated against
+recorded responses, to judge the quality trade-off offline.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tasks_async import generate_summaries_async
+from utils import write_json_file
+from media import synthesize_clip
+from stub_client import AsyncStubClient
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("videos", nargs="*", help="Videos to summarize; a synthetic clip is used if omitted.")
+    parser.add_argument("--latency", type=float, default=1.5, help="Seconds the stub client takes per request.")
+    parser.add_argument("--max_in_flight", type=int, default=8, help="Maximum concurrent requests.")
+    parser.add_argument("--window", type=int, default=50, help="Frames per request window (LLM_IMG_LIMIT).")
+    parser.add_argument("--out", default=None, help="Directory for the per-mode outputs (a temp dir if omitted).")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        out = args.out or tmp
+        os.makedirs(out, exist_ok=True)
+        videos = args.videos
+        if not videos:
+            clip = os.path.join(tmp, "long_scenes.mp4")
+            print("Synthesizing a 6 minute clip with 2 minute scenes...")
+            synthesize_clip(clip, 360, 30, 640, 360, cut_every=120)
+            videos = [clip]
+
+        input_json = os.path.join(tmp, "input.json")
+        write_json_file(input_json, {
+            "taskId": "compare_describe_modes",
+            "files": [{"absolutePath": os.path.abspath(video), "name": os.path.basename(video)} for video in videos]
+        })
+
+        for mode in ("chain", "map_reduce"):
+            client = AsyncStubClient(args.latency)
+            output_json = os.path.join(out, f"{mode}.json")
+            start = time.perf_counter()
+            generate_summaries_async(input_json, output_json, client, args.max_in_flight, mode, args.window)
+            elapsed = time.perf_counter() - start
+            requests = client.completions.requests
+            print(f"{mode:>10}: {elapsed:8.2f}s  {len(requests)} requests  {sum(r['images'] for r in requests)} images  -> {output_json}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,44 @@
+"""Synthetic test footage for the benchmarks."""
+import shutil
+import subprocess
+
+import cv2
+import numpy as np
+
+
+def synthesize_clip(path, seconds, fps=29.97, width=1280, height=720, gop=250, cut_every=None, seed=0):
+    """Writes a clip of `seconds` length. With `cut_every` the picture switches to a
+    new random pattern every that many seconds, which HashDetector sees as a cut;
+    otherwise it is a slowly moving test pattern.
+
+    Uses ffmpeg/libx264 with the given keyframe interval when ffmpeg is on PATH,
+    and OpenCV's mp4v writer (short GOP) otherwise."""
+    rng = np.random.default_rng(seed)
+    total = int(seconds * fps)
+
+    if shutil.which("ffmpeg"):
+        process = subprocess.Popen([
+            "ffmpeg", "-f", "rawvideo", "-pix_fmt", "bgr24", "-s", f"{width}x{height}", "-r", str(fps),
+            "-i", "-", "-c:v", "libx264", "-preset", "ultrafast", "-g", str(gop), "-pix_fmt", "yuv420p",
+            path, "-y", "-nostats", "-loglevel", "0"
+        ], stdin=subprocess.PIPE)
+        write = process.stdin.write
+    else:
+        process = None
+        writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"mp4v"), fps, (width, height))
+        write = writer.write
+
+    pattern = None
+    for i in range(total):
+        if pattern is None or (cut_every and i % int(cut_every * fps) == 0):
+            small = rng.integers(0, 255, (9, 16, 3), dtype=np.uint8)
+            pattern = cv2.resize(small, (width, height), interpolation=cv2.INTER_NEAREST)
+        # a little motion so consecutive frames are not identical
+        frame = np.roll(pattern, i % width, axis=1)
+        write(frame.tobytes() if process else frame)
+
+    if process:
+        process.stdin.close()
+        process.wait()
+    else:
+        writer.release()
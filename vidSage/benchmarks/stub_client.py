@@ -0,0 +1,117 @@
+"""Offline stand-ins for the OpenAI/AzureOpenAI clients used by the tasks.
+
+Only the surface the tasks touch is implemented: `beta.chat.completions.parse`
+and `chat.completions.create`. Every request sleeps for `latency` seconds and is
+recorded, so benchmarks can count requests and image payloads without network
+access. Responses are deterministic and derived from the request, which keeps
+outputs comparable between runs.
+"""
+import asyncio
+import re
+import threading
+import time
+from types import SimpleNamespace
+
+from videoObjects import Description, Shortlist
+
+
+def _image_parts(messages):
+    parts = []
+    for message in messages:
+        if isinstance(message['content'], list):
+            parts.extend(part for part in message['content'] if part.get('type') == 'image_url')
+    return parts
+
+
+def _text(messages):
+    text = ''
+    for message in messages:
+        if isinstance(message['content'], str):
+            text += message['content']
+        else:
+            text += ''.join(part['text'] for part in message['content'] if part.get('type') == 'text')
+    return text
+
+
+def _usage(prompt_tokens, completion_tokens):
+    return SimpleNamespace(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens, total_tokens=prompt_tokens + completion_tokens)
+
+
+class StubCompletions:
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.requests = []
+        self._lock = threading.Lock()
+
+    def _record(self, messages):
+        images = _image_parts(messages)
+        payload = sum(len(part['image_url']['url']) for part in images) + len(_text(messages))
+        with self._lock:
+            self.requests.append({"images": len(images), "bytes": payload})
+        # low detail images cost a flat 85 tokens; roughly 4 characters per text token
+        return images, _usage(85 * len(images) + len(_text(messages)) // 4, 100)
+
+    def _parse(self, response_format, messages):
+        images, usage = self._record(messages)
+        if response_format is Description:
+            parsed = Description(description=f"A sequence of {len(images)} frames.", aestheticRating=3)
+        elif response_format is Shortlist:
+            parsed = Shortlist.model_validate(self.shortlist(messages))
+        else:
+            parsed = response_format.model_validate(self.story(messages))
+        message = SimpleNamespace(parsed=parsed, content=parsed.model_dump_json())
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)], usage=usage)
+
+    def _create(self, messages):
+        _, usage = self._record(messages)
+        message = SimpleNamespace(content=f"A summary of {len(_text(messages))} characters of descriptions.")
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)], usage=usage)
+
+    def story(self, messages):
+        """Story response used for storyline requests; override to script one."""
+        return {"title": "Stub story", "whole_story": "", "scenes": []}
+
+    def shortlist(self, messages):
+        """Shortlist response: every other listed segment, up to the number asked for."""
+        text = _text(messages)
+        keep = int(re.search(r'Pick the (\d+) parts', text).group(1))
+        listed = len(re.findall(r'^\[\d+\] ', text, re.MULTILINE))
+        return {"segments": list(range(0, listed, 2))[:keep]}
+
+    def parse(self, model, response_format, messages, **kwargs):
+        time.sleep(self.latency)
+        return self._parse(response_format, messages)
+
+    def create(self, model, messages, **kwargs):
+        time.sleep(self.latency)
+        return self._create(messages)
+
+
+class AsyncStubCompletions(StubCompletions):
+    async def parse(self, model, response_format, messages, **kwargs):
+        await asyncio.sleep(self.latency)
+        return self._parse(response_format, messages)
+
+    async def create(self, model, messages, **kwargs):
+        await asyncio.sleep(self.latency)
+        return self._create(messages)
+
+
+class StubClient:
+    """Drop-in for OpenAI(); `completions.requests` lists every request made."""
+
+    completions_class = StubCompletions
+
+    def __init__(self, latency=0.0):
+        self.completions = self.completions_class(latency)
+        self.chat = SimpleNamespace(completions=self.completions)
+        self.beta = SimpleNamespace(chat=self.chat)
+
+
+class AsyncStubClient(StubClient):
+    """Drop-in for AsyncOpenAI()."""
+
+    completions_class = AsyncStubCompletions
+
+    async def close(self):
+        pass
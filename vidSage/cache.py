@@ -0,0 +1,263 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+
+import metrics
+from videoObjects import VideoFile, VideoSummary
+
+logger = logging.getLogger(__name__)
+
+CACHE_VERSION = 1
+
+
+def user_data_dir() -> str:
+    """Per-user directory for data that should outlive a task, such as caches."""
+    if sys.platform == 'win32':
+        base = os.getenv('APPDATA', os.path.expanduser('~'))
+    elif sys.platform == 'darwin':
+        base = os.path.expanduser('~/Library/Application Support')
+    else:
+        base = os.getenv('XDG_DATA_HOME', os.path.expanduser('~/.local/share'))
+    return os.path.join(base, 'vidSage')
+
+
+def fingerprint_file(path: str, chunk_size=1024 * 1024) -> str:
+    """Fast content fingerprint: the file size plus a hash of its head, middle and tail.
+
+    Reading three chunks keeps this cheap on multi-GB footage while still
+    changing whenever the file is re-encoded, trimmed or replaced."""
+    size = os.path.getsize(path)
+    digest = hashlib.blake2b(str(size).encode(), digest_size=20)
+    with open(path, 'rb') as f:
+        for offset in sorted({0, max(size // 2 - chunk_size // 2, 0), max(size - chunk_size, 0)}):
+            f.seek(offset)
+            digest.update(f.read(chunk_size))
+    return digest.hexdigest()
+
+
+class SQLiteCache:
+    """Size-bounded key/value table in the shared cache database, evicted least recently used first."""
+
+    table = None
+
+    def __init__(self, path: str = None, max_bytes=256 * 1024 * 1024):
+        if path is None:
+            path = os.path.join(user_data_dir(), 'cache.sqlite')
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.max_bytes = max_bytes
+        # one connection shared by every thread of a long-running process, serialized by _lock
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.RLock()
+        self.conn.execute(
+            f"CREATE TABLE IF NOT EXISTS {self.table} ("
+            "key TEXT PRIMARY KEY, source TEXT, data TEXT, size INTEGER, accessed REAL)"
+        )
+        self.conn.commit()
+
+    def get_raw(self, key: str) -> str:
+        with self._lock:
+            row = self.conn.execute(f"SELECT data FROM {self.table} WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            self.conn.execute(f"UPDATE {self.table} SET accessed = ? WHERE key = ?", (time.time(), key))
+            self.conn.commit()
+            return row[0]
+
+    def put_raw(self, key: str, source: str, data: str) -> None:
+        with self._lock:
+            self.conn.execute(
+                f"INSERT OR REPLACE INTO {self.table} (key, source, data, size, accessed) VALUES (?, ?, ?, ?, ?)",
+                (key, source, data, len(data), time.time())
+            )
+            self.evict()
+            self.conn.commit()
+
+    def evict(self) -> None:
+        """Drops least recently used entries until the table fits in max_bytes."""
+        total = self.conn.execute(f"SELECT COALESCE(SUM(size), 0) FROM {self.table}").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for key, size in self.conn.execute(f"SELECT key, size FROM {self.table} ORDER BY accessed").fetchall():
+            if total <= self.max_bytes:
+                break
+            self.conn.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+            total -= size
+            logger.debug(f"Evicted cache entry {key} from {self.table}")
+
+    def invalidate(self, source_path: str = None) -> int:
+        """Removes the entries for one source file, or every entry. Returns the number removed."""
+        with self._lock:
+            if source_path is None:
+                cursor = self.conn.execute(f"DELETE FROM {self.table}")
+            else:
+                cursor = self.conn.execute(f"DELETE FROM {self.table} WHERE source = ?", (source_path,))
+            self.conn.commit()
+            self.conn.execute("VACUUM")
+            return cursor.rowcount
+
+    def close(self) -> None:
+        self.conn.close()
+
+
+class SummaryCache(SQLiteCache):
+    """Persistent store of VideoSummary results keyed by content and parameters."""
+
+    table = "summaries"
+
+    def key(self, source_path: str, params: dict) -> str:
+        """Cache key for a source file processed with the given pipeline parameters."""
+        payload = json.dumps({"version": CACHE_VERSION, "content": fingerprint_file(source_path), "params": params}, sort_keys=True)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def get(self, key: str, file: dict) -> VideoSummary:
+        """Returns the cached summary for `key`, attributed to `file`, or None."""
+        data = self.get_raw(key)
+        if data is None:
+            metrics.count("summaryCache.misses")
+            return None
+        metrics.count("summaryCache.hits")
+        summary = VideoSummary.from_dict(json.loads(data))
+        # the same content may have been summarized under another path or name
+        summary.file = VideoFile(file['absolutePath'], os.path.basename(file['name']))
+        return summary
+
+    def put(self, key: str, file: dict, summary: VideoSummary) -> None:
+        self.put_raw(key, file['absolutePath'], json.dumps(summary.to_dict()))
+
+
+class ResponseCache(SQLiteCache):
+    """Memoizes single LLM responses keyed by the request itself (model, prompt and frames).
+
+    Keeps hit/miss counts and the tokens and request time that hits saved."""
+
+    table = "responses"
+
+    def __init__(self, path: str = None, max_bytes=256 * 1024 * 1024):
+        super().__init__(path, max_bytes)
+        self.hits = 0
+        self.misses = 0
+        self.saved_tokens = 0
+        self.saved_seconds = 0.0
+
+    def key(self, model: str, messages: list) -> str:
+        payload = json.dumps({"version": CACHE_VERSION, "model": model, "messages": messages}, sort_keys=True)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def get(self, key: str) -> str:
+        """Returns the cached response body for `key`, or None."""
+        data = self.get_raw(key)
+        if data is None:
+            self.misses += 1
+            metrics.count("responseCache.misses")
+            return None
+        entry = json.loads(data)
+        self.hits += 1
+        metrics.count("responseCache.hits")
+        self.saved_tokens += entry["tokens"]
+        self.saved_seconds += entry["seconds"]
+        return entry["response"]
+
+    def put(self, key: str, source: str, response: str, tokens: int, seconds: float) -> None:
+        self.put_raw(key, source, json.dumps({"response": response, "tokens": tokens, "seconds": seconds}))
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "savedTokens": self.saved_tokens,
+            "savedSeconds": round(self.saved_seconds, 3)
+        }
+
+
+# ignored in storyline prompts when searching the segment index
+STOP_WORDS = {"the", "and", "for", "with", "that", "this", "from", "into", "about", "make", "want", "video", "story", "some", "more", "are", "was", "were", "have", "has", "show", "shows", "should", "would", "like", "please"}
+
+
+class SegmentIndex:
+    """Full-text index of every summarized segment, across tasks, in the shared cache
+    database: descriptions and the file summary in an FTS5 table, with the file's
+    aesthetic rating next to them. Lets storylines send only the segments that match
+    the prompt instead of the whole library.
+
+    `available` is False when SQLite was built without FTS5; search then returns None."""
+
+    def __init__(self, path: str = None):
+        if path is None:
+            path = os.path.join(user_data_dir(), 'cache.sqlite')
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.RLock()
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS segments ("
+            "id INTEGER PRIMARY KEY, source TEXT, task TEXT, start_time REAL, end_time REAL, rating INTEGER, indexed REAL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS segments_source ON segments (source)")
+        try:
+            self.conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS segment_text USING fts5(description, summary, tokenize='porter unicode61')")
+            self.available = True
+        except sqlite3.OperationalError as e:
+            logger.warning(f"Segment index unavailable: {e}")
+            self.available = False
+        self.conn.commit()
+
+    def add(self, task_id: str, summary: VideoSummary) -> None:
+        """Indexes the segments of `summary`, replacing what was indexed for its file before."""
+        self.add_all(task_id, [summary])
+
+    def add_all(self, task_id: str, summaries: list) -> None:
+        if not self.available:
+            return
+        with self._lock:
+            for summary in summaries:
+                source = summary.file.absolutePath
+                self._delete(source)
+                for segment in summary.segments:
+                    cursor = self.conn.execute(
+                        "INSERT INTO segments (source, task, start_time, end_time, rating, indexed) VALUES (?, ?, ?, ?, ?, ?)",
+                        (source, task_id, segment.startTimeSec, segment.endTimeSec, summary.aesthetic_rating, time.time())
+                    )
+                    self.conn.execute("INSERT INTO segment_text (rowid, description, summary) VALUES (?, ?, ?)", (cursor.lastrowid, segment.description, summary.summary))
+            self.conn.commit()
+
+    def search(self, prompt: str, sources: list, limit: int) -> list:
+        """Segments of `sources` matching any word of `prompt`, best first, as
+        (source, start, end, rating) tuples. BM25 ranks the matches, weighing the
+        segment's own description above its file's summary, and better rated files
+        move up. Returns None when the index is unavailable."""
+        if not self.available:
+            return None
+        terms = sorted({word for word in re.findall(r'\w+', prompt.lower()) if len(word) > 2 and word not in STOP_WORDS})
+        if not terms:
+            return []
+        query = ' OR '.join(f'"{term}"' for term in terms)
+        with self._lock:
+            return self.conn.execute(
+                "SELECT s.source, s.start_time, s.end_time, s.rating FROM segment_text JOIN segments s ON s.id = segment_text.rowid "
+                "WHERE segment_text MATCH ? AND s.source IN (SELECT value FROM json_each(?)) "
+                "ORDER BY bm25(segment_text, 1.0, 0.3) * (0.8 + 0.1 * s.rating) LIMIT ?",
+                (query, json.dumps(sources), limit)
+            ).fetchall()
+
+    def _delete(self, source: str = None) -> int:
+        where, params = ("WHERE source = ?", (source,)) if source is not None else ("", ())
+        if self.available:
+            self.conn.execute(f"DELETE FROM segment_text WHERE rowid IN (SELECT id FROM segments {where})", params)
+        return self.conn.execute(f"DELETE FROM segments {where}", params).rowcount
+
+    def invalidate(self, source_path: str = None) -> int:
+        """Removes the segments of one source file, or every segment. Returns the number removed."""
+        with self._lock:
+            removed = self._delete(source_path)
+            self.conn.commit()
+            return removed
+
+    def close(self) -> None:
+        self.conn.close()
@@ -0,0 +1,87 @@
+import json
+import logging
+import os
+import shutil
+
+from videoObjects import VideoFile, VideoSummary, Segment
+
+logger = logging.getLogger(__name__)
+
+
+def source_key(path: str) -> dict:
+    """Identifies the version of a source file a checkpoint was made from."""
+    stat = os.stat(path)
+    return {"path": os.path.abspath(path), "size": stat.st_size, "mtime": stat.st_mtime}
+
+
+def write_json_atomic(path: str, data) -> None:
+    # a crash mid-write must not leave a truncated checkpoint behind
+    with open(path + '.part', 'w', encoding='utf-8') as f:
+        json.dump(data, f)
+    os.replace(path + '.part', path)
+
+
+class TaskCheckpoint:
+    """Progress of one generateSummaries task, kept in `folder` (tmp/{task_id}/checkpoint)
+    so a run that stopped part way can be resumed by running the same task again.
+
+    The checkpoint is only reused with the same summary parameters; otherwise it is
+    discarded. It is removed once the task has written its output."""
+
+    def __init__(self, folder: str, params: dict):
+        self.folder = folder
+        meta_path = os.path.join(folder, 'params.json')
+        if os.path.exists(meta_path):
+            with open(meta_path, encoding='utf-8') as f:
+                if json.load(f) != params:
+                    logger.info(f"Summary parameters changed, discarding checkpoint {folder}")
+                    shutil.rmtree(folder)
+        os.makedirs(folder, exist_ok=True)
+        write_json_atomic(meta_path, params)
+
+    def file(self, index: int, file: dict) -> 'FileCheckpoint':
+        return FileCheckpoint(os.path.join(self.folder, f'{index}.json'), file)
+
+    def remove(self) -> None:
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+
+class FileCheckpoint:
+    """Finished scenes of one file and, once it is done, its summary. Each scene keeps
+    its segment, the ratings of its windows and the description the next window's
+    prompt continues from, so the chain picks up exactly where it stopped."""
+
+    def __init__(self, path: str, file: dict):
+        self.path = path
+        self.file = file
+        self.source = source_key(file['absolutePath'])
+        self.state = {"source": self.source, "scenes": [], "summary": None}
+        if os.path.exists(path):
+            try:
+                with open(path, encoding='utf-8') as f:
+                    state = json.load(f)
+                if state.get("source") == self.source:
+                    self.state = state
+                else:
+                    logger.info(f"{file['absolutePath']} changed since it was checkpointed, starting over")
+            except ValueError:
+                logger.warning(f"Ignoring unreadable checkpoint {path}")
+
+    def scenes(self) -> dict:
+        """Finished scenes by their start time."""
+        return {scene["segment"]["startTimeSec"]: scene for scene in self.state["scenes"]}
+
+    def add_scene(self, segment: Segment, ratings: list, context: str) -> None:
+        self.state["scenes"].append({"segment": segment.to_dict(), "ratings": ratings, "context": context})
+        write_json_atomic(self.path, self.state)
+
+    def summary(self) -> VideoSummary:
+        if not self.state["summary"]:
+            return None
+        summary = VideoSummary.from_dict(self.state["summary"])
+        summary.file = VideoFile(self.file['absolutePath'], os.path.basename(self.file['name']))
+        return summary
+
+    def finish(self, summary: VideoSummary) -> None:
+        self.state["summary"] = summary.to_dict()
+        write_json_atomic(self.path, self.state)
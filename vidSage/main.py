@@ -1,46 +1,99 @@
 import shutil
 import sys
-from tasks import generate_summaries, generate_storyline, generate_video, remove_temp_files
-import dotenv
 import os
-from openai import OpenAI, AzureOpenAI
-import uuid
 import subprocess
 import json
 import argparse
 import logging
-import google.generativeai as genai
+import multiprocessing
+import threading
 
+# third-party and pipeline modules are imported by the commands that need them, so
+# quick commands such as cleanUp start without loading cv2, scenedetect or openai
+logger = logging.getLogger()
 
 
+def create_client(provider, args, use_async=False):
+    from openai import OpenAI, AzureOpenAI, AsyncOpenAI, AsyncAzureOpenAI
+    if provider == 'openai':
+        client_class = AsyncOpenAI if use_async else OpenAI
+        return client_class(api_key=args.api_key, max_retries=0)
+    client_class = AsyncAzureOpenAI if use_async else AzureOpenAI
+    return client_class(
+        api_key=args.api_key,
+        azure_endpoint=args.endpoint,
+        azure_deployment=args.deployment_name,
+        api_version='2024-10-01-preview',
+        # retries are handled by RequestScheduler
+        max_retries=0
+    )
+
+
+def get_cache_path(cache_dir):
+    return os.path.join(cache_dir, 'cache.sqlite') if cache_dir else None
+
 
 def get_debug_info():
     # get PATH variable
     path = os.getenv("PATH")
     # get the location of ffmpeg
-    ffmpeg_path = subprocess.run(["which", "ffmpeg"], stdout=subprocess.PIPE).stdout.decode().strip()
+    ffmpeg_path = shutil.which("ffmpeg")
     # get ffmpeg version
-    ffmpeg_version = subprocess.run([ffmpeg_path, "-version"], stdout=subprocess.PIPE).stdout.decode().strip()
+    ffmpeg_version = subprocess.run([ffmpeg_path, "-version"], stdout=subprocess.PIPE).stdout.decode().strip() if ffmpeg_path else None
 
-    ret = {
+    return {
         "path": path,
         "ffmpeg_path": ffmpeg_path,
-        "ffmpeg_version": ffmpeg_version
+        "ffmpeg_version": ffmpeg_version,
+        "ffprobe_path": shutil.which("ffprobe")
     }
-    print(json.dumps(ret))
 
 
-if __name__ == "__main__":
+def required_tools(args) -> tuple:
+    """The executables a command cannot run without. getDebugInfo is how a missing
+    one gets diagnosed, and the cache commands never need them; ffprobe is only
+    needed to cut and render video."""
+    if args.command in ('cleanUp', 'getDebugInfo', 'invalidateCache'):
+        return ()
+    if args.command == 'generateSummaries' or (args.command == 'generateStoryline' and not args.clips):
+        return ('ffmpeg',)
+    return ('ffmpeg', 'ffprobe')
+
+
+def remove_temp_files() -> None:
+    """Removes temporary files."""
+    tmp_folder = './tmp/'
+    shutil.rmtree(tmp_folder)
+
+
+def build_parser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser(description="A tool for generating video summaries, storylines, and final videos.")
+    parser.add_argument('--log_level', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'], default='WARNING', help='Log to stderr from this level up.')
     subparsers = parser.add_subparsers(dest='command', help="Commands")
 
     # Command: cleanUp
     clean_parser = subparsers.add_parser('cleanUp', help='Remove temporary files generated during processing.')
 
+    # Command: getDebugInfo
+    subparsers.add_parser('getDebugInfo', help='Print PATH, the ffmpeg location and version and the ffprobe location as JSON.')
+
+    # Command: invalidateCache
+    invalidate_parser = subparsers.add_parser('invalidateCache', help='Remove cached video summaries, LLM responses and indexed segments.')
+    invalidate_parser.add_argument('--path', help='Only remove the entries for this source video.')
+    invalidate_parser.add_argument('--cache_dir', help='Directory of the summary cache (defaults to the user data directory).')
+
     # Command: generateVideo
     video_parser = subparsers.add_parser('generateVideo', help='Generate a final video based on JSON input.')
     video_parser.add_argument('input_json_path', help='Path to the input JSON file.')
     video_parser.add_argument('output_path', help='Path to the output video file.')
+    video_parser.add_argument('--reencode', action='store_true', help='Re-encode the source ranges to cut them frame-accurately; much slower than the default stream copy, which cuts at keyframes.')
+
+    # Command: clipVideo
+    clip_parser = subparsers.add_parser('clipVideo', help='Cut one scene of a source video on demand, e.g. for a lazily clipped storyline.')
+    clip_parser.add_argument('input_path', help='Path to the source video.')
+    clip_parser.add_argument('output_path', help='Path to the clip; nothing is done if it already exists.')
+    clip_parser.add_argument('start', type=float, help='Start time in seconds.')
+    clip_parser.add_argument('end', type=float, help='End time in seconds.')
 
     # Command: generateSummaries
     summaries_parser = subparsers.add_parser('generateSummaries', help='Generate summaries using the specified provider.')
@@ -50,6 +103,17 @@ if __name__ == "__main__":
     summaries_parser.add_argument('api_key', help='API key for the provider.')
     summaries_parser.add_argument('--endpoint', help='Azure endpoint (required if provider is azure).')
     summaries_parser.add_argument('--deployment_name', help='Azure deployment name (required if provider is azure).')
+    summaries_parser.add_argument('--cache_dir', help='Directory of the summary cache (defaults to the user data directory).')
+    summaries_parser.add_argument('--no_cache', action='store_true', help='Always recompute summaries instead of using the cache.')
+    summaries_parser.add_argument('--max_in_flight', type=int, default=1, help='Maximum concurrent LLM requests; above 1 several files are summarized at once with an async client.')
+    summaries_parser.add_argument('--describe_mode', choices=['chain', 'map_reduce'], default='chain', help='chain: each window builds on the previous description; map_reduce: describe windows in parallel and merge them per scene.')
+    summaries_parser.add_argument('--workers', type=int, default=1, help='Worker processes for decoding, scene detection and frame encoding.')
+    summaries_parser.add_argument('--max_window_mb', type=int, default=32, help='Upper bound on encoded frame data held in memory per request window, in MB.')
+    summaries_parser.add_argument('--encode_profile', choices=['low', 'low_webp', 'high'], default='low', help='Resolution, detail level and image format of the frames sent to the LLM.')
+    summaries_parser.add_argument('--frame_budget', type=int, default=None, help='Sample at most this many frames per file, placed by motion, instead of one per second.')
+    summaries_parser.add_argument('--batch', action='store_true', help='Send the requests as Batch API jobs and wait for them, for bulk ingests held back by per-minute rate limits; rerunning an interrupted task waits for the jobs it already submitted.')
+    summaries_parser.add_argument('--batch_poll_interval', type=float, default=30, help='Seconds between checks on a submitted batch.')
+    summaries_parser.add_argument('--progress', help='Report progress events and each finished summary as NDJSON, to stdout with "-" or appended to this file.')
 
     # Command: generateStoryline
     storyline_parser = subparsers.add_parser('generateStoryline', help='Generate storyline using the specified provider.')
@@ -59,31 +123,125 @@ if __name__ == "__main__":
     storyline_parser.add_argument('api_key', help='API key for the provider.')
     storyline_parser.add_argument('--endpoint', help='Azure endpoint (required if provider is azure).')
     storyline_parser.add_argument('--deployment_name', help='Azure deployment name (required if provider is azure).')
+    storyline_parser.add_argument('--clips', choices=['eager', 'lazy'], help='Also cut every scene to its own clip file (clipFile in the output). lazy returns the storyline without waiting for the clips: under serve they are cut in the background, otherwise each is left to clipVideo on demand.')
+    storyline_parser.add_argument('--clip_workers', type=int, help='Clips cut in parallel (defaults to up to 4).')
+    storyline_parser.add_argument('--storyline_mode', choices=['single', 'hierarchical', 'retrieval'], default='single', help='single: send every segment in one request; hierarchical: shortlist segments per group in parallel first, for libraries too large for one prompt; retrieval: send only the segments the local segment index finds relevant to the prompt.')
+    storyline_parser.add_argument('--cache_dir', help='Directory of the segment index (defaults to the user data directory).')
 
-    args = parser.parse_args()
+    for task_parser in (video_parser, clip_parser, summaries_parser, storyline_parser):
+        task_parser.add_argument('--metrics', help='Write timings of each stage, LLM request sizes and token counts, and retry and cache counters to this JSON file.')
+        task_parser.add_argument('--otlp_endpoint', help='Also export them as a trace to this OTLP/HTTP JSON endpoint, e.g. http://localhost:4318/v1/traces.')
 
-    logger = logging.getLogger()
+    for llm_parser in (summaries_parser, storyline_parser):
+        llm_parser.add_argument('--rpm', type=float, help='Requests per minute allowed by the deployment; requests are paced to stay under it.')
+        llm_parser.add_argument('--tpm', type=float, help='Tokens per minute allowed by the deployment; requests are paced to stay under it.')
 
-    logger.debug("path:" + os.environ['PATH'])
+    # Command: serve
+    subparsers.add_parser('serve', help='Keep running and take commands as line-delimited JSON-RPC on stdin, answering on stdout.')
+
+    return parser
+
+
+class Session:
+    """What is worth keeping between commands: API clients with their connection
+    pools, open caches and request schedulers. A CLI run uses a fresh one; `serve`
+    keeps one for its whole lifetime."""
+
+    def __init__(self):
+        self.clients = {}
+        self.caches = {}
+        self.schedulers = {}
+        # work that may outlive the command that started it, such as lazy clips;
+        # only a long-running session has one
+        self.background = None
+        self._lock = threading.Lock()
+
+    def client(self, args, use_async=False):
+        # async clients are bound to the event loop of the run that created them,
+        # which closes them when it ends
+        if use_async:
+            return create_client(args.provider.lower(), args, True)
+        key = (args.provider.lower(), args.api_key, args.endpoint, args.deployment_name)
+        with self._lock:
+            if key not in self.clients:
+                self.clients[key] = create_client(args.provider.lower(), args)
+            return self.clients[key]
+
+    def scheduler(self, args):
+        from scheduler import RequestScheduler
+        # one per deployment and limits, so pacing and back-off carry over between commands
+        key = (args.provider.lower(), args.api_key, args.endpoint, args.deployment_name, args.rpm, args.tpm)
+        with self._lock:
+            if key not in self.schedulers:
+                self.schedulers[key] = RequestScheduler(args.rpm, args.tpm)
+            return self.schedulers[key]
+
+    def cache(self, cache_class, cache_dir):
+        key = (cache_class, get_cache_path(cache_dir))
+        with self._lock:
+            if key not in self.caches:
+                self.caches[key] = cache_class(get_cache_path(cache_dir))
+            return self.caches[key]
+
+    def close(self):
+        if self.background:
+            # clips already being cut are finished, queued ones are dropped
+            self.background.shutdown(cancel_futures=True)
+        for cache in self.caches.values():
+            cache.close()
+        for client in self.clients.values():
+            client.close()
+
+
+def run_command(args, session: Session, cancelled: threading.Event = None, notify = None):
+    """Runs one parsed command and returns its result. Failures are raised rather than
+    reported, so the CLI and `serve` can each report them their own way. `notify`
+    takes the progress events meant for stdout when stdout is not ours to write to."""
+    if not getattr(args, 'metrics', None) and not getattr(args, 'otlp_endpoint', None):
+        return execute_command(args, session, cancelled, notify)
+
+    import metrics
+    recorder = metrics.Metrics(args.command, input=getattr(args, 'input_json_path', None) or getattr(args, 'input_path', None))
+    try:
+        with metrics.recording(recorder):
+            return execute_command(args, session, cancelled, notify)
+    finally:
+        if args.metrics:
+            recorder.write(args.metrics)
+        if args.otlp_endpoint:
+            try:
+                recorder.export_otlp(args.otlp_endpoint)
+            except Exception as e:
+                logger.warning(f"Could not export metrics to {args.otlp_endpoint}: {e}")
 
-    if not shutil.which("ffmpeg"):
-        sys.stderr.write("ffmpeg not found on the system.")
-        sys.exit(1)
 
+def execute_command(args, session: Session, cancelled: threading.Event = None, notify = None):
     if args.command == 'cleanUp':
         remove_temp_files()
         logger.debug("Temporary files removed.")
-        sys.exit(0)
+        return True
+
+    elif args.command == 'getDebugInfo':
+        return get_debug_info()
+
+    elif args.command == 'invalidateCache':
+        from cache import SummaryCache, ResponseCache, SegmentIndex
+        removed = 0
+        for cache_class in (SummaryCache, ResponseCache, SegmentIndex):
+            removed += session.cache(cache_class, args.cache_dir).invalidate(os.path.abspath(args.path) if args.path else None)
+        logger.debug(f"Removed {removed} cache entries.")
+        return removed
 
     elif args.command == 'generateVideo':
+        from tasks import generate_video
         logger.debug("Generating video...")
-        try:
-            generate_video(args.input_json_path, args.output_path)
-        except Exception as e:
-            sys.stderr.write(str(e))
-            sys.exit(1)
+        generate_video(args.input_json_path, args.output_path, not args.reencode)
         logger.debug("Video generated.")
-        sys.exit(0)
+        return args.output_path
+
+    elif args.command == 'clipVideo':
+        from tasks import cut_clip
+        return cut_clip(args.input_path, args.output_path, args.start, args.end)
 
     elif args.command in ['generateSummaries', 'generateStoryline']:
         provider = args.provider.lower()
@@ -91,36 +249,95 @@ if __name__ == "__main__":
         # Validate provider-specific arguments
         if provider == 'azure':
             if not args.endpoint or not args.deployment_name:
-                parser.error("For azure, --endpoint and --deployment_name are required.")
+                raise ValueError("For azure, --endpoint and --deployment_name are required.")
 
         # Instantiate the client
-        if provider == 'openai':
-            client = OpenAI(api_key=args.api_key)
-        else:
-            client = AzureOpenAI(
-                api_key=args.api_key,
-                azure_endpoint=args.endpoint,
-                azure_deployment=args.deployment_name,
-                api_version='2024-10-01-preview'
-            )
+        use_async = args.command == 'generateSummaries' and not args.batch and (args.max_in_flight > 1 or args.describe_mode == 'map_reduce')
+        client = session.client(args, use_async)
+        scheduler = session.scheduler(args)
+        if cancelled is not None:
+            scheduler = scheduler.with_cancel(cancelled)
 
         if args.command == 'generateSummaries':
+            from cache import SummaryCache, ResponseCache, SegmentIndex
+            from tasks import generate_summaries
+            from tasks_async import generate_summaries_async
             logger.debug("Generating summaries...")
+            cache = None if args.no_cache else session.cache(SummaryCache, args.cache_dir)
+            response_cache = None if args.no_cache else session.cache(ResponseCache, args.cache_dir)
+            index = session.cache(SegmentIndex, args.cache_dir)
+            progress, writer = None, None
+            if args.progress:
+                from progress import ProgressStream, NDJSONWriter
+                if args.progress == '-' and notify:
+                    progress = ProgressStream(notify)
+                else:
+                    writer = NDJSONWriter(args.progress, sys.stdout)
+                    progress = ProgressStream(writer)
             try:
-              generate_summaries(args.input_json_path, args.output_path, client)
-            except Exception as e:
-                sys.stderr.write(str(e))
-                sys.exit(1)
+                if args.batch:
+                    from tasks import MODEL
+                    from tasks_batch import generate_summaries_batch
+                    # Azure names the deployment in each request and has no /v1 prefix
+                    model, endpoint = (args.deployment_name, '/chat/completions') if provider == 'azure' else (MODEL, '/v1/chat/completions')
+                    generate_summaries_batch(args.input_json_path, args.output_path, client, max_window_bytes=args.max_window_mb * 1024 * 1024, cache=cache, workers=args.workers, scheduler=scheduler, frame_budget=args.frame_budget, encode_profile=args.encode_profile, progress=progress, index=index, model=model, endpoint=endpoint, poll_interval=args.batch_poll_interval)
+                elif use_async:
+                    generate_summaries_async(args.input_json_path, args.output_path, client, args.max_in_flight, args.describe_mode, max_window_bytes=args.max_window_mb * 1024 * 1024, cache=cache, response_cache=response_cache, workers=args.workers, scheduler=scheduler, frame_budget=args.frame_budget, encode_profile=args.encode_profile, progress=progress, index=index)
+                else:
+                    generate_summaries(args.input_json_path, args.output_path, client, max_window_bytes=args.max_window_mb * 1024 * 1024, cache=cache, response_cache=response_cache, workers=args.workers, scheduler=scheduler, frame_budget=args.frame_budget, encode_profile=args.encode_profile, progress=progress, index=index)
+            finally:
+                if writer:
+                    writer.close()
             logger.debug("Summaries generated.")
         else:  # generateStoryline
+            from cache import SegmentIndex
+            from tasks import generate_storyline
             logger.debug("Generating storyline...")
-            try:
-              generate_storyline(args.input_json_path, args.output_path, client)
-            except Exception as e:
-                sys.stderr.write(str(e))
-                sys.exit(1)
+            index = session.cache(SegmentIndex, args.cache_dir) if args.storyline_mode == 'retrieval' else None
+            generate_storyline(args.input_json_path, args.output_path, client, scheduler, args.clips, args.clip_workers, args.storyline_mode, index, session.background)
             logger.debug("Storyline generated.")
+        return args.output_path
+
+    raise ValueError(f"Unknown command {args.command}")
+
 
-    else:
+if __name__ == "__main__":
+    # worker processes re-enter the PyInstaller bundle through this entry point
+    multiprocessing.freeze_support()
+
+    parser = build_parser()
+    args = parser.parse_args()
+    logging.basicConfig(level=args.log_level, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+
+    logger.debug("path:" + os.environ['PATH'])
+
+    if args.command is None:
         parser.print_help()
         sys.exit(1)
+
+    for tool in required_tools(args):
+        if not shutil.which(tool):
+            sys.stderr.write(f"{tool} not found on the system.")
+            sys.exit(1)
+
+    session = Session()
+    if args.command == 'serve':
+        from concurrent.futures import ThreadPoolExecutor
+        from server import Server
+        session.background = ThreadPoolExecutor(1, thread_name_prefix='background')
+        # stdout carries the protocol, so anything else printed goes to stderr
+        protocol_out = sys.stdout
+        sys.stdout = sys.stderr
+        Server(parser, run_command, session, sys.stdin, protocol_out).serve()
+        session.close()
+        sys.exit(0)
+
+    try:
+        result = run_command(args, session)
+        if args.command == 'getDebugInfo':
+            print(json.dumps(result))
+    except Exception as e:
+        sys.stderr.write(str(e))
+        sys.exit(1)
+    finally:
+        session.close()
@@ -0,0 +1,175 @@
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+import urllib.request
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# the recorder of the command running in this context; None records nothing
+_current = contextvars.ContextVar('metrics', default=None)
+
+
+class Metrics:
+    """Timings and counters of one command.
+
+    Spans are timed operations with attributes (a probe, an LLM request, a clip);
+    timers sum operations too frequent to record one by one (decoding, scene
+    detection and encoding of single frames); counters count events such as
+    retries and cache hits."""
+
+    def __init__(self, name: str, **attributes):
+        self.name = name
+        self.attributes = attributes
+        self.start = time.time()
+        self.end = None
+        self.spans = []
+        self.timers = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    def add_span(self, name: str, start: float, seconds: float, attributes: dict) -> None:
+        with self._lock:
+            self.spans.append({"name": name, "start": round(start, 6), "seconds": round(seconds, 6), "thread": threading.current_thread().name, "attributes": attributes})
+
+    def add_time(self, name: str, seconds: float, count = 1) -> None:
+        with self._lock:
+            timer = self.timers.setdefault(name, {"count": 0, "seconds": 0.0})
+            timer["count"] += count
+            timer["seconds"] += seconds
+
+    def count(self, name: str, amount = 1) -> None:
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                "name": self.name,
+                "attributes": self.attributes,
+                "start": round(self.start, 6),
+                "seconds": round((self.end or time.time()) - self.start, 6),
+                "spans": list(self.spans),
+                "timers": {name: {"count": timer["count"], "seconds": round(timer["seconds"], 6)} for name, timer in self.timers.items()},
+                "counters": dict(self.counters)
+            }
+
+    def write(self, path: str) -> None:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+    def export_otlp(self, endpoint: str) -> None:
+        """Posts the spans as one trace to an OTLP/HTTP JSON endpoint such as a local
+        collector's http://localhost:4318/v1/traces. The command is the root span and
+        carries the timers and counters as attributes."""
+        data = self.to_dict()
+        trace_id = os.urandom(16).hex()
+        root_id = os.urandom(8).hex()
+
+        def otlp_span(span_id, parent_id, name, start, seconds, attributes):
+            span = {
+                "traceId": trace_id,
+                "spanId": span_id,
+                "name": name,
+                "kind": 1,
+                "startTimeUnixNano": str(int(start * 1e9)),
+                "endTimeUnixNano": str(int((start + seconds) * 1e9)),
+                "attributes": [{"key": key, "value": otlp_value(value)} for key, value in attributes.items() if value is not None]
+            }
+            if parent_id:
+                span["parentSpanId"] = parent_id
+            return span
+
+        root_attributes = dict(data["attributes"])
+        for name, timer in data["timers"].items():
+            root_attributes[f"timer.{name}.seconds"] = timer["seconds"]
+            root_attributes[f"timer.{name}.count"] = timer["count"]
+        for name, value in data["counters"].items():
+            root_attributes[f"counter.{name}"] = value
+        spans = [otlp_span(root_id, None, data["name"], data["start"], data["seconds"], root_attributes)]
+        for span in data["spans"]:
+            spans.append(otlp_span(os.urandom(8).hex(), root_id, span["name"], span["start"], span["seconds"], {**span["attributes"], "thread.name": span["thread"]}))
+
+        body = {"resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": "vidSage"}}]},
+            "scopeSpans": [{"scope": {"name": "vidSage"}, "spans": spans}]
+        }]}
+        request = urllib.request.Request(endpoint, json.dumps(body).encode(), {"Content-Type": "application/json"})
+        with urllib.request.urlopen(request, timeout=10) as response:
+            response.read()
+
+
+def otlp_value(value) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def current() -> Metrics:
+    return _current.get()
+
+
+@contextmanager
+def recording(metrics: Metrics):
+    """Makes `metrics` the recorder of everything run in this context, including
+    threads started through asyncio.to_thread or with run_in_context."""
+    token = _current.set(metrics)
+    try:
+        yield metrics
+    finally:
+        _current.reset(token)
+        metrics.end = time.time()
+
+
+def run_in_context(function):
+    """Wraps `function` to record to the caller's recorder, for thread pools that
+    would otherwise lose it."""
+    metrics = _current.get()
+
+    def run(*args, **kwargs):
+        token = _current.set(metrics)
+        try:
+            return function(*args, **kwargs)
+        finally:
+            _current.reset(token)
+    return run
+
+
+@contextmanager
+def span(name: str, **attributes):
+    """Times the enclosed block as a span. Yields its attributes, which the block may
+    add to, for example with token counts once a response is in."""
+    metrics = _current.get()
+    if metrics is None:
+        yield attributes
+        return
+    start = time.time()
+    started = time.perf_counter()
+    try:
+        yield attributes
+    except BaseException as e:
+        attributes["error"] = type(e).__name__
+        raise
+    finally:
+        metrics.add_span(name, start, time.perf_counter() - started, attributes)
+
+
+def add_time(name: str, seconds: float, count = 1) -> None:
+    """Adds `count` operations taking `seconds` in total to a timer."""
+    metrics = _current.get()
+    if metrics is not None:
+        metrics.add_time(name, seconds, count)
+
+
+def count(name: str, amount = 1) -> None:
+    metrics = _current.get()
+    if metrics is not None:
+        metrics.count(name, amount)
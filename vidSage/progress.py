@@ -0,0 +1,50 @@
+import json
+import threading
+import time
+
+# events, in the order one file goes through them
+RUN_STARTED = "runStarted"
+FILE_STARTED = "fileStarted"
+SCENE_DETECTED = "sceneDetected"
+WINDOW_DESCRIBED = "windowDescribed"
+FILE_DONE = "fileDone"
+FILE_FAILED = "fileFailed"
+RUN_DONE = "runDone"
+
+
+class ProgressStream:
+    """Reports a run as it happens, one event dict at a time, to `send`. Every event
+    has "event" and "time" (Unix seconds); views made by for_file add "index" and
+    "path" so events from files summarized concurrently can be told apart."""
+
+    def __init__(self, send):
+        self.send = send
+        self.fields = {}
+
+    def for_file(self, index: int, path: str) -> 'ProgressStream':
+        view = ProgressStream(self.send)
+        view.fields = {**self.fields, "index": index, "path": path}
+        return view
+
+    def emit(self, event: str, **fields) -> None:
+        self.send({"event": event, "time": round(time.time(), 3), **self.fields, **fields})
+
+
+class NDJSONWriter:
+    """Sends events as NDJSON lines to stdout ("-") or appended to a file, flushing
+    every line so a reader sees each event as soon as it is emitted."""
+
+    def __init__(self, target: str, stdout = None):
+        self.owned = target != '-'
+        self.stream = open(target, 'a', encoding='utf-8') if self.owned else stdout
+        self._lock = threading.Lock()
+
+    def __call__(self, event: dict) -> None:
+        line = json.dumps(event) + "\n"
+        with self._lock:
+            self.stream.write(line)
+            self.stream.flush()
+
+    def close(self) -> None:
+        if self.owned:
+            self.stream.close()
@@ -0,0 +1,275 @@
+import asyncio
+import copy
+import email.utils
+import logging
+import math
+import random
+import re
+import threading
+import time
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+CONTENT_FILTER = "content_filter"
+RATE_LIMIT = "rate_limit"
+RETRYABLE = "retryable"
+FATAL = "fatal"
+
+
+def classify_error(error: Exception) -> str:
+    """Sorts an exception from an LLM request into one of the retry categories."""
+    # imported on first failure; openai is slow to import and utils depends on this module
+    import openai
+
+    if isinstance(error, openai.ContentFilterFinishReasonError):
+        return CONTENT_FILTER
+    if isinstance(error, openai.BadRequestError):
+        text = str(error)
+        if getattr(error, 'code', None) == 'content_filter' or 'content_filter' in text or 'ResponsibleAIPolicyViolation' in text:
+            return CONTENT_FILTER
+        return FATAL
+    if isinstance(error, openai.RateLimitError):
+        return RATE_LIMIT
+    if isinstance(error, (openai.APITimeoutError, openai.APIConnectionError, openai.InternalServerError, openai.ConflictError)):
+        return RETRYABLE
+    if isinstance(error, (openai.AuthenticationError, openai.PermissionDeniedError, openai.NotFoundError, openai.UnprocessableEntityError)):
+        return FATAL
+    if isinstance(error, openai.APIStatusError):
+        return RETRYABLE if error.status_code == 408 or error.status_code >= 500 else FATAL
+    # malformed or truncated structured output can succeed on another attempt
+    return RETRYABLE
+
+
+def parse_duration(value: str) -> float:
+    """Parses rate-limit reset values such as "20ms", "1.5s" or "6m0s" into seconds."""
+    seconds = 0.0
+    for amount, unit in re.findall(r'([\d.]+)(ms|s|m|h)', value):
+        seconds += float(amount) * {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}[unit]
+    return seconds
+
+
+def retry_after_seconds(error: Exception) -> float:
+    """How long the server asked us to wait, from Retry-After or the rate-limit reset headers."""
+    response = getattr(error, 'response', None)
+    if response is None:
+        return None
+    headers = response.headers
+    if headers.get('retry-after-ms'):
+        try:
+            return float(headers['retry-after-ms']) / 1000
+        except ValueError:
+            pass
+    if headers.get('retry-after'):
+        try:
+            return float(headers['retry-after'])
+        except ValueError:
+            pass
+        try:
+            retry_date = email.utils.parsedate_to_datetime(headers['retry-after'])
+        except (TypeError, ValueError):
+            # not a date either; the caller falls back to its own backoff
+            retry_date = None
+        if retry_date:
+            return max(retry_date.timestamp() - time.time(), 0)
+    resets = [parse_duration(headers[name]) for name in ('x-ratelimit-reset-requests', 'x-ratelimit-reset-tokens') if headers.get(name)]
+    exhausted = headers.get('x-ratelimit-remaining-requests') == '0' or headers.get('x-ratelimit-remaining-tokens') == '0'
+    if resets and exhausted:
+        return max(resets)
+    return None
+
+
+def image_tokens(width: int, height: int, detail: str = 'low') -> int:
+    """Tokens billed for one image: a flat 85 at low detail. At high detail the image
+    is fit into 2048x2048, its short side scaled to 768, and each 512px tile costs 170."""
+    if detail == 'low':
+        return 85
+    scale = min(1, 2048 / max(width, height))
+    scale *= min(1, 768 / (min(width, height) * scale))
+    return 85 + 170 * math.ceil(width * scale / 512) * math.ceil(height * scale / 512)
+
+
+# frames are always sent at 16:9, which is 6 tiles at high detail
+HIGH_DETAIL_TOKENS = image_tokens(1366, 768, 'high')
+
+
+def estimate_tokens(messages: list, max_tokens: int = 0) -> int:
+    """Rough token cost of a request as counted against a tokens-per-minute limit."""
+    tokens = max_tokens
+    for message in messages:
+        content = message['content']
+        if isinstance(content, str):
+            tokens += len(content) // 4
+            continue
+        for part in content:
+            if part['type'] == 'text':
+                tokens += len(part['text']) // 4
+            elif part['type'] == 'image_url':
+                tokens += 85 if part['image_url'].get('detail') == 'low' else HIGH_DETAIL_TOKENS
+    return tokens
+
+
+def request_bytes(messages: list) -> int:
+    """Approximate size of a request body: its text plus its image data URLs."""
+    size = 0
+    for message in messages:
+        content = message['content']
+        if isinstance(content, str):
+            size += len(content)
+            continue
+        for part in content:
+            if part['type'] == 'text':
+                size += len(part['text'])
+            elif part['type'] == 'image_url':
+                size += len(part['image_url']['url'])
+    return size
+
+
+def record_usage(attributes: dict, response) -> None:
+    usage = getattr(response, 'usage', None)
+    # batch objects carry usage of another shape
+    if usage is not None and hasattr(usage, 'prompt_tokens'):
+        attributes["promptTokens"] = usage.prompt_tokens
+        attributes["completionTokens"] = usage.completion_tokens
+
+
+class Cancelled(BaseException):
+    """Raised by RequestScheduler once its run is cancelled. Like asyncio.CancelledError
+    it is not an Exception, so per-request error handling lets it through."""
+
+
+class TokenBucket:
+    """Refills at `per_minute` / 60 per second. Bursts are capped at `burst_seconds`
+    worth of budget because providers enforce their limits over short windows."""
+
+    def __init__(self, per_minute: float, burst_seconds = 10):
+        self.rate = per_minute / 60
+        self.capacity = max(self.rate * burst_seconds, 1)
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def reserve(self, cost: float, now: float) -> float:
+        """Takes `cost` from the bucket, possibly going negative, and returns how long
+        the caller has to wait before the reservation is covered."""
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+        self.level -= cost
+        return 0.0 if self.level >= 0 else -self.level / self.rate
+
+
+class RequestScheduler:
+    """Paces LLM requests and decides how to retry them. One instance is shared by
+    every request of a run, sync or async, so pacing and server back-off apply globally.
+
+    Requests are spaced by token buckets for requests and tokens per minute (either
+    limit may be None). Rate-limit and transient errors are retried up to
+    `max_retries` times with exponential backoff and jitter, or after the delay the
+    server asks for. Content-filter errors are handed to the caller's rewrite hook,
+    and anything else fails at once.
+
+    Setting `cancelled` makes every further request, or wait before one, raise Cancelled."""
+
+    def __init__(self, requests_per_minute: float = None, tokens_per_minute: float = None, max_retries = 5, base_delay = 1.0, max_delay = 60.0):
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retries = 0
+        self.cancelled = threading.Event()
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+        # views made by with_cancel keep their pacing state here
+        self._root = self
+
+    def with_cancel(self, cancelled: threading.Event) -> 'RequestScheduler':
+        """A view of this scheduler for one run: pacing, server back-off and the retry
+        count stay shared, but `cancelled` only stops the requests made through the view."""
+        view = copy.copy(self)
+        view.cancelled = cancelled
+        return view
+
+    def _check_cancelled(self) -> None:
+        if self.cancelled.is_set():
+            raise Cancelled()
+
+    def _reserve(self, tokens: int) -> float:
+        root = self._root
+        with root._lock:
+            now = time.monotonic()
+            delay = root._blocked_until - now
+            if self.requests:
+                delay = max(delay, self.requests.reserve(1, now))
+            if self.tokens:
+                delay = max(delay, self.tokens.reserve(tokens, now))
+            return max(delay, 0.0)
+
+    def _on_error(self, error: Exception, state: dict, filter_attempts: int, on_content_filter) -> float:
+        """Returns the delay before the next attempt, or re-raises when giving up."""
+        kind = classify_error(error)
+        logger.warning(f"LLM request failed ({kind}): {error}")
+        metrics.count(f"llm.errors.{kind}")
+        if kind == CONTENT_FILTER:
+            state['filtered'] += 1
+            if state['filtered'] >= filter_attempts:
+                raise error
+            if on_content_filter:
+                on_content_filter()
+            return 0.0
+        if kind == FATAL or state['retries'] >= self.max_retries:
+            raise error
+
+        state['retries'] += 1
+        metrics.count("llm.retries")
+        root = self._root
+        with root._lock:
+            root.retries += 1
+        delay = retry_after_seconds(error)
+        if delay is None:
+            backoff = min(self.max_delay, self.base_delay * 2 ** (state['retries'] - 1))
+            delay = backoff / 2 + random.uniform(0, backoff / 2)
+        elif kind == RATE_LIMIT:
+            # the limit is shared, so hold back every request, not just this one
+            with root._lock:
+                root._blocked_until = max(root._blocked_until, time.monotonic() + delay)
+        return delay
+
+    def call(self, request, tokens: int = 0, filter_attempts = 3, on_content_filter = None, name = 'llm', payload_bytes = 0):
+        """Runs `request()` with pacing and retries and returns its result.
+
+        `tokens` is the estimated cost of the request, `filter_attempts` how many
+        times it may be sent before a content-filter rejection is final, and
+        `on_content_filter` rewrites the request between those attempts. Every
+        attempt is recorded as a span called `name`, with the request's size."""
+        state = {'filtered': 0, 'retries': 0}
+        while True:
+            # wait on the event so a cancellation ends the wait early
+            self.cancelled.wait(self._reserve(tokens))
+            self._check_cancelled()
+            try:
+                with metrics.span(name, estimatedTokens=tokens, payloadBytes=payload_bytes, attempt=state['filtered'] + state['retries'] + 1) as attributes:
+                    response = request()
+                    record_usage(attributes, response)
+                return response
+            except Exception as e:
+                self.cancelled.wait(self._on_error(e, state, filter_attempts, on_content_filter))
+
+    async def call_async(self, request, tokens: int = 0, filter_attempts = 3, on_content_filter = None, name = 'llm', payload_bytes = 0):
+        """Async counterpart of call; `request()` returns an awaitable."""
+        state = {'filtered': 0, 'retries': 0}
+        while True:
+            await self._sleep_async(self._reserve(tokens))
+            self._check_cancelled()
+            try:
+                with metrics.span(name, estimatedTokens=tokens, payloadBytes=payload_bytes, attempt=state['filtered'] + state['retries'] + 1) as attributes:
+                    response = await request()
+                    record_usage(attributes, response)
+                return response
+            except Exception as e:
+                await self._sleep_async(self._on_error(e, state, filter_attempts, on_content_filter))
+
+    async def _sleep_async(self, delay: float) -> None:
+        end = time.monotonic() + delay
+        while not self.cancelled.is_set() and time.monotonic() < end:
+            await asyncio.sleep(min(end - time.monotonic(), 0.25))
@@ -0,0 +1,136 @@
+"""Line-delimited JSON-RPC 2.0 over a pair of streams, used by `main.py serve`."""
+import argparse
+import json
+import logging
+import threading
+
+from scheduler import Cancelled
+
+logger = logging.getLogger(__name__)
+
+PARSE_ERROR = -32700
+INVALID_REQUEST = -32600
+METHOD_NOT_FOUND = -32601
+INVALID_PARAMS = -32602
+SERVER_ERROR = -32000
+REQUEST_CANCELLED = -32800
+
+
+class Server:
+    """Serves the `main.py` commands to one client, keeping `session` warm between them.
+
+    Every input line is a request such as
+    {"jsonrpc": "2.0", "id": 1, "method": "generateSummaries", "params": ["in.json", "out.json", "openai", "<key>"]}
+    whose params are the command's CLI arguments. Requests run concurrently, one
+    thread each, and every request with an id gets one response line. `cancel`, with
+    the id of a running request as its only param, stops that request at its next
+    LLM request; `shutdown` or the end of input stops the server once running
+    requests have finished.
+
+    Progress events of a request run with `--progress -` are sent as `progress`
+    notifications whose params are the event plus the id of the request."""
+
+    def __init__(self, parser: argparse.ArgumentParser, run_command, session, reader, writer):
+        self.parser = parser
+        self.run_command = run_command
+        self.session = session
+        self.reader = reader
+        self.writer = writer
+        self.commands = set()
+        for action in parser._actions:
+            if isinstance(action, argparse._SubParsersAction):
+                self.commands.update(action.choices)
+        self.commands.discard('serve')
+        self.running = {}
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def serve(self) -> None:
+        for line in self.reader:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                request = json.loads(line)
+            except ValueError:
+                self.respond(None, error=(PARSE_ERROR, "Parse error"))
+                continue
+            if not isinstance(request, dict) or not isinstance(request.get('method'), str):
+                self.respond(request.get('id') if isinstance(request, dict) else None, error=(INVALID_REQUEST, "Invalid request"))
+                continue
+
+            method = request['method']
+            if method == 'shutdown':
+                self.reply(request, result=True)
+                break
+            elif method == 'cancel':
+                self.reply(request, result=self.cancel(request.get('params')))
+            elif method not in self.commands:
+                self.reply(request, error=(METHOD_NOT_FOUND, f"Unknown method {method}"))
+            else:
+                # registered before the thread starts so it can be cancelled right away
+                cancelled = threading.Event()
+                with self._lock:
+                    self.running[request.get('id')] = cancelled
+                thread = threading.Thread(target=self.handle, args=(request, cancelled), daemon=True)
+                self._threads.append(thread)
+                thread.start()
+
+        for thread in self._threads:
+            thread.join()
+
+    def cancel(self, params) -> bool:
+        """Cancels the running request whose id is the first param; False if there is none."""
+        request_id = params[0] if isinstance(params, list) and params else None
+        with self._lock:
+            cancelled = self.running.get(request_id)
+        if cancelled is None:
+            return False
+        cancelled.set()
+        return True
+
+    def handle(self, request: dict, cancelled: threading.Event) -> None:
+        try:
+            params = request.get('params', [])
+            if not isinstance(params, list):
+                self.reply(request, error=(INVALID_PARAMS, "params must be the list of command line arguments"))
+                return
+            try:
+                args = self.parser.parse_args([request['method']] + [str(param) for param in params])
+            except SystemExit:
+                # argparse has already written the reason to stderr
+                self.reply(request, error=(INVALID_PARAMS, f"Invalid arguments for {request['method']}"))
+                return
+            if cancelled.is_set():
+                raise Cancelled()
+            notify = lambda event: self.notify('progress', {"id": request.get('id'), **event})
+            self.reply(request, result=self.run_command(args, self.session, cancelled, notify))
+        except Cancelled:
+            self.reply(request, error=(REQUEST_CANCELLED, "Request cancelled"))
+        except Exception as e:
+            logger.error(e)
+            self.reply(request, error=(SERVER_ERROR, str(e)))
+        finally:
+            with self._lock:
+                self.running.pop(request.get('id'), None)
+
+    def reply(self, request: dict, result=None, error=None) -> None:
+        # requests without an id are notifications and get no response
+        if 'id' in request:
+            self.respond(request['id'], result, error)
+
+    def respond(self, request_id, result=None, error=None) -> None:
+        message = {"jsonrpc": "2.0", "id": request_id}
+        if error:
+            message["error"] = {"code": error[0], "message": error[1]}
+        else:
+            message["result"] = result
+        self.write(message)
+
+    def notify(self, method: str, params: dict) -> None:
+        self.write({"jsonrpc": "2.0", "method": method, "params": params})
+
+    def write(self, message: dict) -> None:
+        with self._lock:
+            self.writer.write(json.dumps(message) + "\n")
+            self.writer.flush()
@@ -1,170 +1,489 @@
+import math
 import os
 import sys
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+from itertools import groupby
 from typing import List
-from scenedetect import detect, HashDetector
+from scenedetect import HashDetector
 import shutil
 
-from utils import read_json_file, write_json_file, preprocess_video, extract_frames_fixed, reduce_resolution, base64_encode_frames, concat_videos, clip_video
-from videoObjects import VideoFile, Segment, VideoSummary, Story, Scene, Description
+import metrics
+from utils import read_json_file, write_json_file, iter_frame_windows, ENCODE_PROFILES, spill_frame_windows, load_frame_windows, render_ranges, clip_video
+from cache import SummaryCache, ResponseCache, SegmentIndex
+from scheduler import RequestScheduler, estimate_tokens, request_bytes
+from checkpoint import TaskCheckpoint, FileCheckpoint
+from progress import ProgressStream, RUN_STARTED, FILE_STARTED, SCENE_DETECTED, WINDOW_DESCRIBED, FILE_DONE, FILE_FAILED, RUN_DONE
+from videoObjects import VideoFile, Segment, VideoSummary, Story, Scene, Description, FrameWindow, Shortlist
 import logging
 
 
 logger = logging.getLogger(__name__)
 
+MODEL = "gpt-4o"
+SCENE_THRESHOLD = 0.45
+# frames closer than this to the previous kept frame are not sent
+DEDUP_THRESHOLD = 0.1
+FRAME_INTERVAL = 1
+# image tokens per description request; high detail frames fill it long before LLM_IMG_LIMIT
+MAX_WINDOW_TOKENS = 16000
+# ffmpeg processes cutting storyline clips at once
+CLIP_WORKERS = min(4, os.cpu_count() or 1)
+# hierarchical storylines: prompt tokens of segment listing per request, segments
+# handed to the final pass, and shortlist requests in flight
+SHORTLIST_GROUP_TOKENS = 8000
+SHORTLIST_SIZE = 60
+SHORTLIST_WORKERS = 4
+# retrieval storylines: seconds of footage retrieved per second of story, and the
+# fewest and most segments sent whatever the duration
+RETRIEVAL_COVERAGE = 3
+RETRIEVAL_MIN_SEGMENTS = 20
+RETRIEVAL_MAX_SEGMENTS = 150
+
+
+FILTER_WARNING = "\n Your last response was filtered by the Azure content filter. Please avoid using inappropriate language."
+
+
+def window_messages(window: FrameWindow, previous_description: str = None) -> list:
+    """Builds the description request for one window of frames."""
+    messages = [
+        { "role": "system", "content": "You are good at analyzing the video willing to provide the detailed descriptions of the video, include all the objects you see in the video as well as the position of the objects." },
+        { "role": "user", "content": [
+            {
+                "type": "text",
+                "text":
+                f"""
+                Give me the detailed description of the provided sequence of frames from the video. Additionally, give me the aesthetic rating from 1 to 5 for the sequence of frames.
+                """
+            }
+        ] }
+    ]
+    if previous_description:
+        messages[1]['content'][0]['text'] += f"\n Here are previous descriptions from {window.scene_start} to {window.start - 1} seconds, combine the previous description and give me a new description \n" + previous_description
 
-def generate_summaries(input_json_path: str, output_json_path: str, llm_client, LLM_IMG_LIMIT = 50) -> bool:
-    """Generates video summaries based on input JSON."""
-    args = read_json_file(input_json_path)
-    task_id = args['taskId']
-    files = args['files']
+    profile = ENCODE_PROFILES[window.profile]
+    for frame in window.frames:
+        messages[1]['content'].append(
+            {
+                "type": "image_url",
+                "image_url": {
+                    "url" : f"data:{profile.mime};base64,{frame}",
+                    "detail": profile.detail
+                }
+            }
+        )
+    return messages
 
 
-    #create a temp directory
-    task_folder = f'./tmp/{task_id}'
-    os.makedirs(task_folder, exist_ok=True)
-    scenes = {}
+def summary_messages(segments: List[Segment]) -> list:
+    """Builds the request that condenses the segment descriptions into a short summary."""
+    whole = ''
+    for segment in segments:
+        whole += 'from ' + str(segment.startTimeSec) + ' to ' + str(segment.endTimeSec) + ' seconds: \n'
+        whole += segment.description + '\n'
 
-    #preprocess the video files and detect scenes
-    logger.debug("Preprocessing videos...")
-    for file in files:
-        input_vid_path = file['absolutePath']
-        filename = os.path.basename(input_vid_path)
-        output_vid_path = f'{task_folder}/{filename}'
-        logger.debug(f"Preprocessing video: {input_vid_path}")
-        preprocess_video(input_vid_path, output_vid_path)
+    return [
+        { "role": "user", "content": [
+            {
+                "type": "text",
+                "text":
+                f"""
+                Based on the description of the video from each part, give me a short summary of the video.
+
+                {whole}
+                """
+            }
+        ] }
+    ]
 
-        scene_list = detect(output_vid_path, HashDetector(threshold=0.45))
-        scene_sec = []
-        for scene in scene_list:
-            scene_sec.append((int(scene[0].get_seconds()), int(scene[1].get_seconds())))
 
-        scenes[file['absolutePath']] = scene_sec
-        os.remove(output_vid_path)
-    logger.debug("Preprocessing complete.")
+def summary_cache_params(LLM_IMG_LIMIT: int, frame_budget: int = None, encode_profile = 'low') -> dict:
+    """Everything besides the file content that changes a summary."""
+    params = {
+        "interval": FRAME_INTERVAL,
+        "detector": f"hash:{SCENE_THRESHOLD}",
+        "dedup": DEDUP_THRESHOLD,
+        "encode": ENCODE_PROFILES[encode_profile].to_dict(),
+        "window": LLM_IMG_LIMIT,
+        "windowTokens": MAX_WINDOW_TOKENS,
+        "model": MODEL
+    }
+    # only present when set, so fixed-rate summaries keep their existing keys
+    if frame_budget:
+        params["frameBudget"] = frame_budget
+    return params
+
+
+def open_frame_windows(input_vid_path: str, LLM_IMG_LIMIT = 50, max_window_bytes = 32 * 1024 * 1024, frame_budget = None, encode_profile = 'low'):
+    """Streams the request windows of a video with the pipeline's sampling and scene
+    detection settings. `frame_budget` switches to motion-adaptive sampling of at most
+    that many frames per file, and `encode_profile` names one of ENCODE_PROFILES."""
+    return iter_frame_windows(input_vid_path, HashDetector(threshold=SCENE_THRESHOLD), LLM_IMG_LIMIT, FRAME_INTERVAL, ENCODE_PROFILES[encode_profile], max_window_bytes, MAX_WINDOW_TOKENS, dedup_threshold=DEDUP_THRESHOLD, frame_budget=frame_budget)
+
+
+def prepare_windows(input_vid_path: str, out_dir: str, LLM_IMG_LIMIT = 50, max_window_bytes = 32 * 1024 * 1024, frame_budget = None, encode_profile = 'low') -> list:
+    """The CPU-bound part of summarizing a video (decode, scene detection, resize and
+    JPEG encoding), meant to run in a worker process. Returns the spilled window files."""
+    return spill_frame_windows(open_frame_windows(input_vid_path, LLM_IMG_LIMIT, max_window_bytes, frame_budget, encode_profile), out_dir)
+
+
+class ChatRequest:
+    """One chat completion request, sent the same way by the sync and the async
+    tasks: through the scheduler, with a warning added to the prompt after a content
+    filter hit. `call` and `call_async` return the response content, None if the
+    request failed for good."""
+
+    def __init__(self, name: str, messages: list, response_format = None, max_tokens = 4000):
+        self.name = name
+        self.messages = messages
+        self.response_format = response_format
+        self.max_tokens = max_tokens
+
+    def send(self, llm_client):
+        """Sends the request once; with an async client this returns the awaitable."""
+        if self.response_format:
+            return llm_client.beta.chat.completions.parse(model=MODEL, response_format=self.response_format, messages=self.messages, max_tokens=self.max_tokens)
+        return llm_client.chat.completions.create(model=MODEL, messages=self.messages, max_tokens=self.max_tokens)
+
+    def add_filter_warning(self) -> None:
+        # the instructions are the first part of the last (user) message
+        self.messages[-1]['content'][0]['text'] += FILTER_WARNING
+
+    def result(self, response, seconds: float):
+        return response.choices[0].message.content
+
+    def call(self, llm_client, scheduler: RequestScheduler):
+        start = time.perf_counter()
+        try:
+            response = scheduler.call(lambda: self.send(llm_client), estimate_tokens(self.messages, self.max_tokens), 3, self.add_filter_warning, self.name, request_bytes(self.messages))
+        except Exception as e:
+            logger.error(e)
+            return None
+        return self.result(response, time.perf_counter() - start)
+
+    async def call_async(self, llm_client, scheduler: RequestScheduler, in_flight):
+        """Like `call`; `in_flight` (an asyncio.Semaphore) bounds concurrent requests."""
+        async def request():
+            async with in_flight:
+                return await self.send(llm_client)
+
+        start = time.perf_counter()
+        try:
+            response = await scheduler.call_async(request, estimate_tokens(self.messages, self.max_tokens), 3, self.add_filter_warning, self.name, request_bytes(self.messages))
+        except Exception as e:
+            logger.error(e)
+            return None
+        return self.result(response, time.perf_counter() - start)
+
+
+class DescribeRequest(ChatRequest):
+    """The description request of one window, memoized in `response_cache`: `cached`
+    holds the earlier response, if any, so the request need not be sent."""
+
+    def __init__(self, messages: list, source: str, response_cache: ResponseCache = None):
+        super().__init__('llm.describe', messages, Description)
+        self.source = source
+        self.response_cache = response_cache
+        self.key = response_cache.key(MODEL, messages) if response_cache else None
+        cached = response_cache.get(self.key) if response_cache else None
+        self.cached = Description.model_validate_json(cached) if cached else None
+
+    def result(self, response, seconds: float) -> Description:
+        desc = response.choices[0].message.parsed
+        if self.response_cache:
+            tokens = response.usage.total_tokens if response.usage else 0
+            self.response_cache.put(self.key, self.source, desc.model_dump_json(), tokens, seconds)
+        return desc
+
+
+def describe_window(llm_client, messages: list, source: str, response_cache: ResponseCache = None, scheduler: RequestScheduler = None) -> Description:
+    """Asks the LLM to describe one window of frames, reusing a memoized response when possible."""
+    request = DescribeRequest(messages, source, response_cache)
+    return request.cached or request.call(llm_client, scheduler or RequestScheduler())
+
+
+def summarize_segments(llm_client, segments: List[Segment], scheduler: RequestScheduler = None) -> str:
+    """Asks the LLM for a short summary of the whole video."""
+    return ChatRequest('llm.summarize', summary_messages(segments)).call(llm_client, scheduler or RequestScheduler())
+
+
+def summarize_video(file: dict, llm_client, LLM_IMG_LIMIT = 50, max_window_bytes = 32 * 1024 * 1024, response_cache: ResponseCache = None, windows = None, scheduler: RequestScheduler = None, frame_budget = None, encode_profile = 'low', progress: ProgressStream = None, checkpoint: FileCheckpoint = None) -> VideoSummary:
+    """Detects the scenes of one video and describes them with the LLM. `windows` may
+    supply windows prepared elsewhere; by default the video is decoded here. Scenes
+    finished in `checkpoint` are taken from it instead of being described again."""
+    input_vid_path = file['absolutePath']
+    logger.debug(f"Generating summary for video: {input_vid_path}")
+    # decode once and stream one window of encoded frames at a time
+    if windows is None:
+        windows = open_frame_windows(input_vid_path, LLM_IMG_LIMIT, max_window_bytes, frame_budget, encode_profile)
+    chain = SceneChain(progress, checkpoint)
+    for startTimeSec, scene_windows in groupby(windows, key=lambda window: window.scene_start):
+        if chain.resume(startTimeSec):
+            continue
+        chain.start_scene(startTimeSec)
+        for window in scene_windows:
+            desc = describe_window(llm_client, chain.messages(window), input_vid_path, response_cache, scheduler)
+            chain.described(window, desc)
+        chain.end_scene()
+
+    whole_summary = summarize_segments(llm_client, chain.segments, scheduler)
+    return chain.summary(file, whole_summary)
+
+
+class SceneChain:
+    """Scene by scene state of the chain mode, shared by summarize_video and
+    tasks_async.summarize_video_async: the segments so far, the ratings, and the
+    last description, which the next window's prompt continues from. Scenes are
+    restored from and saved to the file's checkpoint, and reported to `progress`."""
+
+    def __init__(self, progress: ProgressStream = None, checkpoint: FileCheckpoint = None):
+        self.progress = progress
+        self.checkpoint = checkpoint
+        self.finished = checkpoint.scenes() if checkpoint else {}
+        self.output_messages = []
+        self.segments = []
+        self.ratings = []
+        self.segment = None
+        self.scene_failed = False
+        self.failed = False
+
+    def resume(self, startTimeSec) -> bool:
+        """Takes the scene starting at `startTimeSec` from the checkpoint if it was finished."""
+        if startTimeSec not in self.finished:
+            return False
+        scene = self.finished[startTimeSec]
+        self.segments.append(Segment.from_dict(scene['segment']))
+        self.ratings.extend(scene['ratings'])
+        if scene['context']:
+            self.output_messages.append(scene['context'])
+        return True
+
+    def start_scene(self, startTimeSec) -> None:
+        self.segment = Segment(startTimeSec, startTimeSec, "filtered")
+        self.scene_start = len(self.ratings)
+        self.scene_failed = False
+        if self.progress:
+            self.progress.emit(SCENE_DETECTED, startTimeSec=startTimeSec)
+
+    def messages(self, window: FrameWindow) -> list:
+        """The description request for the next window of the current scene."""
+        self.segment.endTimeSec = window.end
+        return window_messages(window, self.output_messages[-1] if self.output_messages else None)
+
+    def described(self, window: FrameWindow, desc: Description) -> None:
+        if desc:
+            self.output_messages.append(desc.description)
+            self.ratings.append(desc.aestheticRating)
+        else:
+            self.scene_failed = True
+            self.failed = True
+        if self.progress:
+            self.progress.emit(WINDOW_DESCRIBED, **window_event(window, desc))
+
+    def end_scene(self) -> None:
+        segment = self.segment
+        if self.output_messages:
+            segment.description = self.output_messages[-1]
+        self.segments.append(segment)
+        # a scene with a failed window is described again by the next run; the
+        # descriptions it did get still carry on to the following scene
+        if self.checkpoint and not self.scene_failed:
+            self.checkpoint.add_scene(segment, self.ratings[self.scene_start:], self.output_messages[-1] if self.output_messages else None)
+        logger.debug(f"Segment from {segment.startTimeSec} to {segment.endTimeSec} seconds: {segment.description}")
+        if len(self.ratings) > self.scene_start:
+            logger.debug(f"Rating: {self.ratings[-1]}")
+
+    def summary(self, file: dict, whole_summary: str) -> VideoSummary:
+        return VideoSummary(VideoFile(file['absolutePath'], os.path.basename(file['name'])), whole_summary, average_rating(self.ratings), self.segments, not self.failed and whole_summary is not None)
+
+
+def average_rating(ratings: List[int]) -> int:
+    """The rating of a whole file, 0 if none of its windows could be described."""
+    return round(sum(ratings) / len(ratings)) if ratings else 0
+
+
+def window_event(window: FrameWindow, desc: Description) -> dict:
+    """Fields of a windowDescribed event; description is None if the request failed."""
+    return {
+        "sceneStartTimeSec": window.scene_start,
+        "startTimeSec": window.start,
+        "endTimeSec": window.end,
+        "frames": len(window.frames),
+        "description": desc.description if desc else None
+    }
+
+
+class SummaryRun:
+    """Setup and teardown shared by generate_summaries, tasks_async.generate_summaries_async
+    and tasks_batch.generate_summaries_batch: the cached or checkpointed summary of
+    each file, the worker processes preparing the others, progress events, and the
+    output, cache and index once files are done.
+
+    Finished files are checkpointed under tmp/{task_id}, with `params`, so running a
+    task that failed, or had requests fail, again resumes it instead of starting over."""
+
+    def __init__(self, input_json_path: str, params: dict, cache: SummaryCache = None, response_cache: ResponseCache = None, progress: ProgressStream = None, index: SegmentIndex = None):
+        args = read_json_file(input_json_path)
+        self.task_id = args['taskId']
+        self.files = args['files']
+        self.task_folder = f'./tmp/{self.task_id}'
+        os.makedirs(self.task_folder, exist_ok=True)
+        self.cache = cache
+        self.response_cache = response_cache
+        self.progress = progress
+        self.index = index
+        self.keys = [cache.key(file['absolutePath'], params) if cache else None for file in self.files]
+        self.cached = [cache.get(key, file) if cache else None for key, file in zip(self.keys, self.files)]
+        self.checkpoint = TaskCheckpoint(f'{self.task_folder}/checkpoint', params)
+        self.checkpoints = [self.checkpoint.file(i, file) for i, file in enumerate(self.files)]
+        for i, checkpoint in enumerate(self.checkpoints):
+            self.cached[i] = self.cached[i] or checkpoint.summary()
+        self.remaining = [i for i, summary in enumerate(self.cached) if not summary]
+        self.file_progress = [progress.for_file(i, file['absolutePath']) if progress else None for i, file in enumerate(self.files)]
+        self.pool = None
+        self.prepared = {}
+        if progress:
+            progress.emit(RUN_STARTED, taskId=self.task_id, files=len(self.files))
+
+    def prepare(self, workers: int, LLM_IMG_LIMIT: int, max_window_bytes: int, frame_budget: int = None, encode_profile = 'low') -> None:
+        """With several workers, starts decoding and encoding every remaining file in
+        worker processes right away, while the LLM works through them."""
+        if workers > 1:
+            self.pool = ProcessPoolExecutor(workers)
+            for i in self.remaining:
+                self.prepared[i] = self.pool.submit(prepare_windows, self.files[i]['absolutePath'], f'{self.task_folder}/windows/{i}', LLM_IMG_LIMIT, max_window_bytes, frame_budget, encode_profile)
+
+    def windows(self, i: int):
+        """The windows the workers prepared for file `i`, None if it was left to the caller."""
+        return load_frame_windows(self.prepared[i].result()) if i in self.prepared else None
+
+    def close(self) -> None:
+        """Stops the worker processes and removes the windows they left behind."""
+        if self.pool:
+            self.pool.shutdown(cancel_futures=True)
+            shutil.rmtree(f'{self.task_folder}/windows', ignore_errors=True)
+            self.pool = None
+
+    def started(self, i: int) -> None:
+        if self.file_progress[i]:
+            self.file_progress[i].emit(FILE_STARTED)
+
+    def take_cached(self, i: int) -> VideoSummary:
+        """Reports and returns the cached or checkpointed summary of file `i`, if any."""
+        summary = self.cached[i]
+        if summary:
+            logger.debug(f"Cache hit for video: {self.files[i]['absolutePath']}")
+            self.started(i)
+            self.done(i, summary)
+        return summary
+
+    @contextmanager
+    def summarizing(self, i: int):
+        """Reports file `i` as started, and as failed if summarizing it raises. Yields
+        the file's progress stream."""
+        self.started(i)
+        try:
+            with metrics.span("summarize", path=self.files[i]['absolutePath']):
+                yield self.file_progress[i]
+        except Exception as e:
+            if self.file_progress[i]:
+                self.file_progress[i].emit(FILE_FAILED, error=str(e))
+            raise
+
+    def done(self, i: int, summary: VideoSummary) -> VideoSummary:
+        """Keeps a newly finished summary for reruns and reports it."""
+        if summary is not self.cached[i] and summary.complete:
+            self.checkpoints[i].finish(summary)
+            # a summary with failed requests would be served until invalidated
+            if self.cache:
+                self.cache.put(self.keys[i], self.files[i], summary)
+        if self.file_progress[i]:
+            self.file_progress[i].emit(FILE_DONE, cached=summary is self.cached[i], summary=summary.to_dict())
+        return summary
+
+    def finish(self, output_json_path: str, summaries: List[VideoSummary]) -> None:
+        """Writes the output of the run and indexes it."""
+        if self.response_cache:
+            stats = self.response_cache.stats()
+            logger.info(f"Response cache: {stats['hits']} hits, {stats['misses']} misses, saved {stats['savedTokens']} tokens and {stats['savedSeconds']}s of requests")
+        write_json_file(output_json_path, [summary.to_dict() for summary in summaries])
+        # with failed requests, the checkpoint lets a rerun redo only those scenes
+        if all(summary.complete for summary in summaries):
+            self.checkpoint.remove()
+        if self.index:
+            self.index.add_all(self.task_id, summaries)
+        if self.progress:
+            self.progress.emit(RUN_DONE, output=output_json_path)
+
+
+def generate_summaries(input_json_path: str, output_json_path: str, llm_client, LLM_IMG_LIMIT = 50, max_window_bytes = 32 * 1024 * 1024, cache: SummaryCache = None, response_cache: ResponseCache = None, workers = 1, scheduler: RequestScheduler = None, frame_budget = None, encode_profile = 'low', progress: ProgressStream = None, index: SegmentIndex = None) -> bool:
+    """Generates video summaries based on input JSON. With `progress`, each file's
+    progress and finished summary are reported as they happen, before the output
+    JSON is written at the end.
+
+    Finished files and scenes are checkpointed under tmp/{task_id}, so running a
+    task that failed, or had requests fail, again resumes it instead of starting
+    over. Scenes with a failed request are not checkpointed and are redone."""
+    run = SummaryRun(input_json_path, summary_cache_params(LLM_IMG_LIMIT, frame_budget, encode_profile), cache, response_cache, progress, index)
 
     logger.debug("Generating summaries...")
-    #generate summaries
     summaries = []
-    for file in files:
-        input_vid_path = file['absolutePath']
-        logger.debug(f"Generating summary for video: {input_vid_path}")
-        frames = extract_frames_fixed(input_vid_path)
-        reduced_frames = reduce_resolution(frames, 1280, 720)
-        encoded_frames = base64_encode_frames(reduced_frames)
-        output_messages = []
-        scene_sec = scenes[input_vid_path]
-        if not scene_sec:
-            scene_sec = [(0, len(frames))]
-        segments = []
-        ratings = []
-        for scene in scene_sec:
-            startTimeSec = scene[0]
-            endTimeSec = scene[1]
-            segment = Segment(startTimeSec, endTimeSec, "filtered")
-            for i in range(startTimeSec, endTimeSec, LLM_IMG_LIMIT):
-                end_second = min(i + LLM_IMG_LIMIT - 1, endTimeSec - 1)
-                messages = [
-                    { "role": "system", "content": "You are good at analyzing the video willing to provide the detailed descriptions of the video, include all the objects you see in the video as well as the position of the objects." },
-                    { "role": "user", "content": [
-                        {
-                            "type": "text",
-                            "text":
-                            f"""
-                            Give me the detailed description of the provided sequence of frames from the video. Additionally, give me the aesthetic rating from 1 to 5 for the sequence of frames.
-                            """
-                        }
-                    ] }
-                ]
-                if output_messages:
-                    messages[1]['content'][0]['text'] += f"\n Here are previous descriptions from {startTimeSec} to {i - 1} seconds, combine the previous description and give me a new description \n" + output_messages[-1]
-
-                for frame in (encoded_frames[i:i+LLM_IMG_LIMIT] if i+LLM_IMG_LIMIT < end_second else encoded_frames[i:end_second]):
-                    messages[1]['content'].append(
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url" : f"data:image/jpeg;base64,{frame}",
-                                "detail": "low"
-                            }
-                        }
-                    )
-                for _ in range(3):
-                    try:
-                        response = llm_client.beta.chat.completions.parse(
-                            model="gpt-4o",
-                            response_format=Description,
-                            messages=messages,
-                            max_tokens=4000
-                        )
-                        desc = response.choices[0].message.parsed
-                        output_messages.append(desc.description)
-                        ratings.append(desc.aestheticRating)
-                        break
-                    except Exception as e:
-                        logger.error(e)
-                        messages[1]['content'][0]['text'] += "\n Your last response was filtered by the Azure content filter. Please avoid using inappropriate language."
-
-            if output_messages:
-                segment.description = output_messages[-1]
-            segments.append(segment)
-            logger.debug(f"Segment from {startTimeSec} to {endTimeSec} seconds: {segment.description}")
-            logger.debug(f"Rating: {ratings[-1]}")
-
-        whole = ''
-        for segment in segments:
-            whole += 'from ' + str(segment.startTimeSec) + ' to ' + str(segment.endTimeSec) + ' seconds: \n'
-            whole += segment.description + '\n'
-
-        messages = [
-            { "role": "user", "content": [
-                {
-                    "type": "text",
-                    "text":
-                    f"""
-                    Based on the description of the video from each part, give me a short summary of the video.
-
-                    {whole}
-                    """
-                }
-            ] }
-        ]
-        for _ in range(3):
-            try:
-                response = llm_client.chat.completions.create(
-                    model="gpt-4o",
-                    messages=messages,
-                    max_tokens=4000
-                )
-                whole_summary = response.choices[0].message.content
-                break
-            except Exception as e:
-                logger.error(e)
-                messages[0]['content'][0]['text'] += "\n Your last response was filtered by the Azure content filter. Please avoid using inappropriate language."
-
-        rating = round(sum(ratings) / len(ratings))
-        summaries.append(VideoSummary(VideoFile(file['absolutePath'], os.path.basename(file['name'])), whole_summary, rating, segments))
-
-    write_json_file(output_json_path, [summary.to_dict() for summary in summaries])
+    # one scheduler for the whole run so pacing and back-off are shared across files
+    scheduler = scheduler or RequestScheduler()
+    try:
+        # with several workers, all remaining files are decoded and encoded in parallel
+        # while the LLM works through them in order
+        run.prepare(workers, LLM_IMG_LIMIT, max_window_bytes, frame_budget, encode_profile)
+        for i, file in enumerate(run.files):
+            summary = run.take_cached(i)
+            if not summary:
+                with run.summarizing(i) as file_progress:
+                    summary = summarize_video(file, llm_client, LLM_IMG_LIMIT, max_window_bytes, response_cache, run.windows(i), scheduler, frame_budget, encode_profile, file_progress, run.checkpoints[i])
+                run.done(i, summary)
+            summaries.append(summary)
+    finally:
+        run.close()
+
+    run.finish(output_json_path, summaries)
 
     return True
 
 
-def generate_storyline(input_json_path: str, output_json_path: str, llm_client) -> bool:
-    """Generates a storyline based on video summaries and a user prompt."""
-    args = read_json_file(input_json_path)
-    task_id = args['taskId']
-    summaries = args['summaries']
-    prompt = args['prompt']
-    duration = args['duration']
+def cut_clip(input_vid_path: str, output_vid_path: str, start_time: int, end_time: int) -> str:
+    """Cuts one clip unless it already exists. The clip is written under a temporary
+    name and renamed once complete, so a file at `output_vid_path` is always whole."""
+    if not os.path.exists(output_vid_path):
+        root, ext = os.path.splitext(output_vid_path)
+        partial = f'{root}.part{ext}'
+        with metrics.span("clip", path=input_vid_path, start=start_time, end=end_time):
+            clip_video(input_vid_path, partial, start_time, end_time)
+        os.replace(partial, output_vid_path)
+    return output_vid_path
+
+
+def cut_clips(jobs: list, workers = CLIP_WORKERS) -> list:
+    """Cuts (source, clip, start, end) jobs with at most `workers` ffmpeg processes at
+    a time. Returns whether each job succeeded; failures are logged, not raised."""
+    done = []
+    with ThreadPoolExecutor(max(workers, 1)) as pool:
+        futures = [pool.submit(metrics.run_in_context(cut_clip), *job) for job in jobs]
+        for job, future in zip(jobs, futures):
+            try:
+                future.result()
+                done.append(True)
+            except Exception as e:
+                logger.error(f"Failed to clip {job[0]} from {job[2]} to {job[3]}: {e}")
+                done.append(False)
+    return done
 
 
-    task_folder = f'./tmp/{task_id}'
-    os.makedirs(task_folder, exist_ok=True)
-    all_summaries = ""
-    for summary in summaries:
-        for segment in summary['segments']:
-            all_summaries += f"{summary['file']['absolutePath']} from {segment['startTimeSec']} to {segment['endTimeSec']}: \n {segment['description']} \n ---------------- \n"
+def segment_line(summary: dict, segment: dict) -> str:
+    """How one segment is listed to the storyline model."""
+    return f"{summary['file']['absolutePath']} from {segment['startTimeSec']} to {segment['endTimeSec']}: \n {segment['description']} \n ---------------- \n"
+
 
+def storyline_messages(all_summaries: str, prompt: str, duration) -> list:
     messages = [
         { "role": "system", "content": "You are very helpful and are very good at giving storyline based on the footages" },
         { "role": "user", "content": [
@@ -198,56 +517,219 @@ def generate_storyline(input_json_path: str, output_json_path: str, llm_client)
             """
         }
     )
+    return messages
+
+
+def shortlist_messages(lines: List[str], prompt: str, duration, keep: int) -> list:
+    listing = ''.join(f"[{i}] {line}" for i, line in enumerate(lines))
+    text = f"""
+                The following are numbered parts of videos from a larger collection. A story of around {duration} minutes will be edited from parts of the whole collection.
+                Pick the {keep} parts or fewer that are the most worth including in the story, and answer with their numbers.
+                """
+    if prompt != "":
+        text += f"""
+                Here is the prompt user want the story to be based on:
+                {prompt}
+                """
+    return [
+        { "role": "system", "content": "You are very helpful and are very good at giving storyline based on the footages" },
+        { "role": "user", "content": [
+            { "type": "text", "text": text },
+            { "type": "text", "text": listing }
+        ] }
+    ]
+
+
+def shortlist_group(llm_client, lines: List[str], prompt: str, duration, keep: int, scheduler: RequestScheduler) -> List[str]:
+    """Asks the LLM for the `keep` most promising of `lines`, in their original order.
+    If the request fails, an evenly spaced selection is kept instead."""
+    messages = shortlist_messages(lines, prompt, duration, keep)
+
+    def request():
+        return llm_client.beta.chat.completions.parse(
+            model=MODEL,
+            response_format=Shortlist,
+            messages=messages,
+            max_tokens=500
+        )
+
+    def add_filter_warning():
+        messages[1]['content'][0]['text'] += FILTER_WARNING
+
+    try:
+        response = scheduler.call(request, estimate_tokens(messages, 500), 2, add_filter_warning, 'llm.shortlist', request_bytes(messages))
+        picked = sorted({i for i in response.choices[0].message.parsed.segments if 0 <= i < len(lines)})[:keep]
+    except Exception as e:
+        logger.error(e)
+        picked = []
+    if not picked:
+        picked = sorted({int(i * len(lines) / keep) for i in range(keep)})
+    return [lines[i] for i in picked]
+
+
+def shortlist_segments(llm_client, lines: List[str], prompt: str, duration, scheduler: RequestScheduler, group_tokens = SHORTLIST_GROUP_TOKENS, shortlist_size = SHORTLIST_SIZE, workers = SHORTLIST_WORKERS) -> List[str]:
+    """Narrows the segment listing down until it fits in `group_tokens`, so the final
+    storyline prompt stays bounded whatever the size of the library.
+
+    Each round packs consecutive segments (so mostly one file per group) into
+    groups of at most `group_tokens`, and each group keeps its share of
+    `shortlist_size`, at most half of it, in parallel requests."""
+    rounds = 0
+    while sum(len(line) for line in lines) // 4 > group_tokens:
+        rounds += 1
+        groups = [[]]
+        group_size = 0
+        for line in lines:
+            if groups[-1] and group_size + len(line) // 4 > group_tokens:
+                groups.append([])
+                group_size = 0
+            groups[-1].append(line)
+            group_size += len(line) // 4
+        keeps = [max(1, min(math.ceil(shortlist_size * len(group) / len(lines)), len(group) // 2)) for group in groups]
+        with ThreadPoolExecutor(max(workers, 1)) as pool:
+            futures = [pool.submit(metrics.run_in_context(shortlist_group), llm_client, group, prompt, duration, keep, scheduler) for group, keep in zip(groups, keeps)]
+            shortlisted = [line for future in futures for line in future.result()]
+        logger.debug(f"Shortlist round {rounds}: kept {len(shortlisted)} of {len(lines)} segments in {len(groups)} groups")
+        if len(shortlisted) >= len(lines):
+            break
+        lines = shortlisted
+    return lines
+
+
+def retrieve_segments(index: SegmentIndex, task_id: str, summaries: list, prompt: str, duration, coverage = RETRIEVAL_COVERAGE, min_segments = RETRIEVAL_MIN_SEGMENTS, max_segments = RETRIEVAL_MAX_SEGMENTS) -> List[str]:
+    """Lists only the segments the segment index finds relevant to `prompt`, enough
+    of them to cover `coverage` times the story's duration, in their input order.
+
+    The input summaries are indexed first, so summaries from before the index or
+    edited since are searched as they are now. When too few segments match (or
+    the prompt is empty), the best rated of the rest make up the difference."""
+    segments = {(summary['file']['absolutePath'], segment['startTimeSec'], segment['endTimeSec']): (summary, segment) for summary in summaries for segment in summary['segments']}
+    index.add_all(task_id, [VideoSummary.from_dict(summary) for summary in summaries])
+    ranked = index.search(prompt, sorted({summary['file']['absolutePath'] for summary in summaries}), max_segments)
+    if ranked is None:
+        return [segment_line(summary, segment) for summary, segment in segments.values()]
+
+    budget = float(duration) * 60 * coverage
+    picked = set()
+    footage = 0
+    best_rated = sorted(segments, key=lambda key: -(segments[key][0]['aestheticRating'] or 0))
+    for key in [row[:3] for row in ranked] + best_rated:
+        if len(picked) >= max_segments or (len(picked) >= min_segments and footage >= budget):
+            break
+        if key in segments and key not in picked:
+            picked.add(key)
+            footage += key[2] - key[1]
+    logger.debug(f"Retrieved {len(picked)} of {len(segments)} segments, {len(ranked)} matching the prompt")
+    return [segment_line(summary, segment) for key, (summary, segment) in segments.items() if key in picked]
+
+
+def generate_storyline(input_json_path: str, output_json_path: str, llm_client, scheduler: RequestScheduler = None, clips = None, clip_workers = None, mode = 'single', index: SegmentIndex = None, background: Executor = None) -> bool:
+    """Generates a storyline based on video summaries and a user prompt.
+
+    In 'single' mode every segment is sent in one request. In 'hierarchical' mode
+    libraries too large for one prompt are first narrowed down to a shortlist by
+    parallel requests over groups of segments (see shortlist_segments), and only
+    the shortlist is sent to the final storyline request. In 'retrieval' mode the
+    segments are searched in the persistent segment `index` for the prompt, and
+    only the best matches are sent (see retrieve_segments), without extra requests.
+
+    With `clips`, each scene is also cut to its own file, for players that cannot
+    seek the source, using up to `clip_workers` parallel ffmpeg processes. "eager"
+    cuts them before the storyline is written; "lazy" writes the storyline with the
+    clip paths without waiting for them. Lazy clips are cut on `background`, an
+    executor that outlives the call, when there is one; otherwise they are left to
+    be cut on demand, e.g. with clipVideo, since the caller only gets the storyline
+    once the process is done."""
+    clip_workers = clip_workers or CLIP_WORKERS
+    args = read_json_file(input_json_path)
+    task_id = args['taskId']
+    summaries = args['summaries']
+    prompt = args['prompt']
+    duration = args['duration']
+    scheduler = scheduler or RequestScheduler()
+
+
+    task_folder = f'./tmp/{task_id}'
+    os.makedirs(task_folder, exist_ok=True)
+    lines = [segment_line(summary, segment) for summary in summaries for segment in summary['segments']]
+    if mode == 'hierarchical':
+        lines = shortlist_segments(llm_client, lines, prompt, duration, scheduler)
+    elif mode == 'retrieval':
+        with metrics.span("retrieve", segments=len(lines)) as attributes:
+            lines = retrieve_segments(index or SegmentIndex(), task_id, summaries, prompt, duration)
+            attributes["retrieved"] = len(lines)
+    messages = storyline_messages(''.join(lines), prompt, duration)
+    def request():
+        return llm_client.beta.chat.completions.parse(
+            model=MODEL,
+            response_format=Story,
+            messages=messages,
+            max_tokens=2000
+        )
+
+    def add_filter_warning():
+        messages[1]['content'][0]['text'] += FILTER_WARNING
+
     out_story = None
-    for _ in range(2):
-      try:
-          response = llm_client.beta.chat.completions.parse(
-              model="gpt-4o",
-              response_format=Story,
-              messages=messages,
-              max_tokens=2000
-          )
-          out_story = response.choices[0].message.parsed
-          break
-      except Exception as e:
-          logging.error(e)
-          messages[1]['content'][0]['text'] += "\n Your last response was filtered by the Azure content filter. Please avoid using inappropriate language."
+    try:
+        response = scheduler.call(request, estimate_tokens(messages, 2000), 2, add_filter_warning, 'llm.storyline', request_bytes(messages))
+        out_story = response.choices[0].message.parsed
+    except Exception as e:
+        logger.error(e)
 
     if not out_story:
         raise Exception("Failed to generate a storyline.")
 
     storyline = []
+    jobs = []
 
     tmp_folder = f'./tmp/{task_id}/clips'
-    os.makedirs(tmp_folder, exist_ok=True)
     for scene in out_story.scenes:
         input_vid_path = scene.file_path
         if not os.path.exists(input_vid_path):
             logger.error(f"File {input_vid_path} does not exist.")
             continue
-        # use ffmpeg to extract the scene
         filename = os.path.basename(input_vid_path)
-
-        output_vid_path = f'{tmp_folder}/{filename}_{scene.start}_{scene.end}.mp4'
-
-        clip_video(input_vid_path, output_vid_path, scene.start, scene.end)
-        storyline.append({
+        # segments point at their source range; the preview seeks into it and
+        # generate_video renders from it, so no copy is needed for either
+        segment = {
             "startTimeSec": scene.start,
             "endTimeSec": scene.end,
             "description": scene.story,
             "srcFile": {
+                "absolutePath": os.path.abspath(input_vid_path),
+                "name": filename
+            }
+        }
+        if clips:
+            output_vid_path = f'{tmp_folder}/{filename}_{scene.start}_{scene.end}.mp4'
+            jobs.append((input_vid_path, output_vid_path, scene.start, scene.end))
+            segment["clipFile"] = {
                 "absolutePath": os.path.abspath(output_vid_path),
                 "name": f"{filename}_{scene.start}_{scene.end}.mp4"
             }
-        })
+        storyline.append(segment)
+
+    if jobs:
+        os.makedirs(tmp_folder, exist_ok=True)
+    if clips == 'eager':
+        for segment, done in zip([segment for segment in storyline if "clipFile" in segment], cut_clips(jobs, clip_workers)):
+            if not done:
+                del segment["clipFile"]
 
     write_json_file(output_json_path, storyline)
 
+    if clips == 'lazy' and background and jobs:
+        # the storyline is already usable; clips appear as they complete
+        background.submit(cut_clips, jobs, clip_workers)
+
     return True
 
 
-def generate_video(input_json_path: str, output_video_path: str) -> bool:
-    """Generates a video file from segments."""
+def generate_video(input_json_path: str, output_video_path: str, stream_copy = True) -> bool:
+    """Generates a video file from segments, rendering each segment's range of its
+    source file directly rather than joining pre-cut clips. The ranges are stream
+    copied unless `stream_copy` is off or the sources cannot be joined that way."""
     args = read_json_file(input_json_path)
     task_id = args['taskId']
     storyline = args['segments']
@@ -255,18 +737,8 @@ def generate_video(input_json_path: str, output_video_path: str) -> bool:
     task_folder = f'./tmp/{task_id}'
     os.makedirs(task_folder, exist_ok=True)
 
-    video_list = [story['srcFile']['absolutePath'] for story in storyline]
-    tmp_folder = f'./tmp/{task_id}'
-    with open(f'{tmp_folder}/vid_list.txt', 'w') as f:
-        for video in video_list:
-            f.write(f"file '{video}'\n")
-
-    concat_videos(f'{tmp_folder}/vid_list.txt', output_video_path)
+    ranges = [(story['srcFile']['absolutePath'], story['startTimeSec'], story['endTimeSec']) for story in storyline]
+    render_ranges(ranges, output_video_path, task_folder, stream_copy)
 
     return True
 
-def remove_temp_files() -> None:
-    """Removes temporary files."""
-    tmp_folder = './tmp/'
-    shutil.rmtree(tmp_folder)
-
@@ -0,0 +1,201 @@
+import asyncio
+import os
+from itertools import groupby
+from typing import List
+
+from utils import load_frame_windows
+from cache import SummaryCache, ResponseCache, SegmentIndex
+from scheduler import RequestScheduler
+from tasks import ChatRequest, DescribeRequest, SceneChain, SummaryRun, average_rating, window_messages, window_event, summary_messages, summary_cache_params, open_frame_windows
+from checkpoint import FileCheckpoint
+from progress import ProgressStream, SCENE_DETECTED, WINDOW_DESCRIBED
+from videoObjects import VideoFile, Segment, VideoSummary, Description
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+async def describe_window_async(llm_client, messages: list, source: str, in_flight: asyncio.Semaphore, scheduler: RequestScheduler, response_cache: ResponseCache = None) -> Description:
+    """Async counterpart of tasks.describe_window; `in_flight` bounds concurrent requests."""
+    request = DescribeRequest(messages, source, response_cache)
+    return request.cached or await request.call_async(llm_client, scheduler, in_flight)
+
+
+async def summarize_segments_async(llm_client, segments: List[Segment], in_flight: asyncio.Semaphore, scheduler: RequestScheduler) -> str:
+    return await ChatRequest('llm.summarize', summary_messages(segments)).call_async(llm_client, scheduler, in_flight)
+
+
+async def summarize_video_async(file: dict, llm_client, in_flight: asyncio.Semaphore, scheduler: RequestScheduler, LLM_IMG_LIMIT = 50, max_window_bytes = 32 * 1024 * 1024, response_cache: ResponseCache = None, windows = None, frame_budget = None, encode_profile = 'low', progress: ProgressStream = None, checkpoint: FileCheckpoint = None) -> VideoSummary:
+    """Async counterpart of tasks.summarize_video. Decoding runs in a worker thread
+    so other files keep talking to the LLM meanwhile."""
+    input_vid_path = file['absolutePath']
+    logger.debug(f"Generating summary for video: {input_vid_path}")
+    if windows is None:
+        windows = open_frame_windows(input_vid_path, LLM_IMG_LIMIT, max_window_bytes, frame_budget, encode_profile)
+    scenes = groupby(windows, key=lambda window: window.scene_start)
+    chain = SceneChain(progress, checkpoint)
+    while True:
+        scene = await asyncio.to_thread(next, scenes, None)
+        if scene is None:
+            break
+        startTimeSec, scene_windows = scene
+        if chain.resume(startTimeSec):
+            continue
+        chain.start_scene(startTimeSec)
+        while True:
+            window = await asyncio.to_thread(next, scene_windows, None)
+            if window is None:
+                break
+            desc = await describe_window_async(llm_client, chain.messages(window), input_vid_path, in_flight, scheduler, response_cache)
+            chain.described(window, desc)
+        chain.end_scene()
+
+    whole_summary = await summarize_segments_async(llm_client, chain.segments, in_flight, scheduler)
+    return chain.summary(file, whole_summary)
+
+
+def merge_messages(segment: Segment, descriptions: List[str]) -> list:
+    """Builds the reduce request of the map-reduce mode, which merges independent
+    window descriptions of one scene."""
+    parts = ''
+    for i, description in enumerate(descriptions):
+        parts += f'part {i + 1}: \n' + description + '\n'
+    return [
+        { "role": "user", "content": [
+            {
+                "type": "text",
+                "text":
+                f"""
+                The following are descriptions of consecutive parts of one scene of a video, from {segment.startTimeSec} to {segment.endTimeSec} seconds. Combine them into one detailed description of the scene, include all the objects as well as the position of the objects.
+
+                {parts}
+                """
+            }
+        ] }
+    ]
+
+
+async def merge_descriptions_async(llm_client, segment: Segment, descriptions: List[str], in_flight: asyncio.Semaphore, scheduler: RequestScheduler) -> str:
+    """Reduce step of the map-reduce mode: merges independent window descriptions of one scene."""
+    return await ChatRequest('llm.merge', merge_messages(segment, descriptions)).call_async(llm_client, scheduler, in_flight)
+
+
+async def summarize_video_map_reduce(file: dict, llm_client, in_flight: asyncio.Semaphore, scheduler: RequestScheduler, LLM_IMG_LIMIT = 50, max_window_bytes = 32 * 1024 * 1024, response_cache: ResponseCache = None, windows = None, max_pending = 8, frame_budget = None, encode_profile = 'low', progress: ProgressStream = None, checkpoint: FileCheckpoint = None) -> VideoSummary:
+    """Like summarize_video_async, but windows are described independently and in
+    parallel instead of each prompt carrying the previous description. Scenes with
+    several windows are merged with one extra text-only request."""
+    input_vid_path = file['absolutePath']
+    logger.debug(f"Generating summary for video (map-reduce): {input_vid_path}")
+    if windows is None:
+        windows = open_frame_windows(input_vid_path, LLM_IMG_LIMIT, max_window_bytes, frame_budget, encode_profile)
+    # encoded windows waiting for a response are held in memory, so cap them
+    pending = asyncio.Semaphore(max_pending)
+    segments = []
+    scene_tasks = []
+    finished = checkpoint.scenes() if checkpoint else {}
+
+    async def describe(window):
+        try:
+            desc = await describe_window_async(llm_client, window_messages(window), input_vid_path, in_flight, scheduler, response_cache)
+            if progress:
+                progress.emit(WINDOW_DESCRIBED, **window_event(window, desc))
+            return desc
+        finally:
+            pending.release()
+
+    while True:
+        await pending.acquire()
+        window = await asyncio.to_thread(next, windows, None)
+        if window is None:
+            pending.release()
+            break
+        if window.scene_start in finished:
+            pending.release()
+            if not segments or segments[-1].startTimeSec != window.scene_start:
+                segments.append(Segment.from_dict(finished[window.scene_start]['segment']))
+                scene_tasks.append(None)
+            continue
+        if not segments or segments[-1].startTimeSec != window.scene_start:
+            segments.append(Segment(window.scene_start, window.scene_start, "filtered"))
+            scene_tasks.append([])
+            if progress:
+                progress.emit(SCENE_DETECTED, startTimeSec=window.scene_start)
+        segments[-1].endTimeSec = window.end
+        scene_tasks[-1].append(asyncio.create_task(describe(window)))
+
+    async def reduce(segment, tasks):
+        if tasks is None:
+            return finished[segment.startTimeSec]['ratings'], True
+        descs = [desc for desc in await asyncio.gather(*tasks) if desc]
+        complete = len(descs) == len(tasks)
+        if len(descs) == 1:
+            segment.description = descs[0].description
+        elif descs:
+            merged = await merge_descriptions_async(llm_client, segment, [desc.description for desc in descs], in_flight, scheduler)
+            if merged:
+                segment.description = merged
+            else:
+                complete = False
+        logger.debug(f"Segment from {segment.startTimeSec} to {segment.endTimeSec} seconds: {segment.description}")
+        # scenes with a failed request are left for the next run to describe again
+        if checkpoint and complete:
+            checkpoint.add_scene(segment, [desc.aestheticRating for desc in descs], None)
+        return [desc.aestheticRating for desc in descs], complete
+
+    ratings = []
+    complete = True
+    for scene_ratings, scene_complete in await asyncio.gather(*(reduce(segment, tasks) for segment, tasks in zip(segments, scene_tasks))):
+        ratings.extend(scene_ratings)
+        complete = complete and scene_complete
+
+    whole_summary = await summarize_segments_async(llm_client, segments, in_flight, scheduler)
+    return VideoSummary(VideoFile(file['absolutePath'], os.path.basename(file['name'])), whole_summary, average_rating(ratings), segments, complete and whole_summary is not None)
+
+
+async def _generate_summaries(run: SummaryRun, llm_client, max_in_flight: int, mode: str, LLM_IMG_LIMIT: int, max_window_bytes: int, response_cache: ResponseCache, scheduler: RequestScheduler, frame_budget: int = None, encode_profile: str = 'low') -> List[VideoSummary]:
+    in_flight = asyncio.Semaphore(max_in_flight)
+    # each file holds one window in memory, so bound the files in progress as well
+    active_files = asyncio.Semaphore(max_in_flight)
+    summarize_video = summarize_video_map_reduce if mode == 'map_reduce' else summarize_video_async
+
+    async def summarize(i, file):
+        summary = run.take_cached(i)
+        if summary:
+            return summary
+        async with active_files:
+            with run.summarizing(i) as file_progress:
+                windows = load_frame_windows(await asyncio.wrap_future(run.prepared[i])) if i in run.prepared else None
+                summary = await summarize_video(file, llm_client, in_flight, scheduler, LLM_IMG_LIMIT, max_window_bytes, response_cache, windows, frame_budget=frame_budget, encode_profile=encode_profile, progress=file_progress, checkpoint=run.checkpoints[i])
+            return run.done(i, summary)
+
+    try:
+        # gather keeps the input order no matter which file finishes first
+        return await asyncio.gather(*(summarize(i, file) for i, file in enumerate(run.files)))
+    finally:
+        # the client's connections belong to this event loop, which ends with the run
+        await llm_client.close()
+
+
+def generate_summaries_async(input_json_path: str, output_json_path: str, llm_client, max_in_flight = 4, mode = 'chain', LLM_IMG_LIMIT = 50, max_window_bytes = 32 * 1024 * 1024, cache: SummaryCache = None, response_cache: ResponseCache = None, workers = 1, scheduler: RequestScheduler = None, frame_budget = None, encode_profile = 'low', progress: ProgressStream = None, index: SegmentIndex = None) -> bool:
+    """Generates video summaries like tasks.generate_summaries, summarizing several
+    files at once with an AsyncOpenAI/AsyncAzureOpenAI client, which is closed when
+    the run ends.
+
+    `mode` is 'chain' (each window's prompt carries the previous description, as in
+    tasks.py) or 'map_reduce' (windows described in parallel, then merged per scene)."""
+    params = summary_cache_params(LLM_IMG_LIMIT, frame_budget, encode_profile)
+    params["mode"] = mode
+    run = SummaryRun(input_json_path, params, cache, response_cache, progress, index)
+
+    logger.debug(f"Generating summaries with up to {max_in_flight} requests in flight...")
+    try:
+        # the worker processes start on every remaining file right away
+        run.prepare(workers, LLM_IMG_LIMIT, max_window_bytes, frame_budget, encode_profile)
+        summaries = asyncio.run(_generate_summaries(run, llm_client, max_in_flight, mode, LLM_IMG_LIMIT, max_window_bytes, response_cache, scheduler or RequestScheduler(), frame_budget, encode_profile))
+    finally:
+        run.close()
+
+    run.finish(output_json_path, summaries)
+
+    return True
@@ -0,0 +1,288 @@
+import json
+import logging
+import os
+import shutil
+
+import metrics
+from cache import SummaryCache, SegmentIndex
+from scheduler import RequestScheduler, Cancelled
+from checkpoint import source_key, write_json_atomic
+from tasks import MODEL, SummaryRun, average_rating, window_messages, summary_messages, summary_cache_params, open_frame_windows
+from tasks_async import merge_messages
+from progress import ProgressStream
+from videoObjects import VideoFile, Segment, VideoSummary, Description
+
+logger = logging.getLogger(__name__)
+
+# limits of one batch input file
+BATCH_MAX_REQUESTS = 50000
+BATCH_MAX_BYTES = 190 * 1024 * 1024
+BATCH_POLL_INTERVAL = 30
+# statuses a batch does not leave
+BATCH_FINAL = ("completed", "failed", "expired", "cancelled")
+
+
+def response_format(model) -> dict:
+    """The structured output format `parse` would send for a pydantic model, spelled
+    out for request bodies that do not go through the client."""
+    schema = model.model_json_schema()
+    schema["additionalProperties"] = False
+    return {"type": "json_schema", "json_schema": {"name": model.__name__, "schema": schema, "strict": True}}
+
+
+class BatchJob:
+    """One round of chat completion requests sent through the Batch API instead of
+    one by one, for runs that can wait hours but not hit per-minute rate limits.
+
+    Requests are written to JSONL files in `folder`, split to stay within the limits
+    of one batch, then uploaded and submitted. The ids of the submitted batches, their
+    results once downloaded (the provider's copies are deleted then) and each
+    request's `meta` are kept in `folder`/{name}.json, so running the task
+    again after an interruption waits for those batches instead of paying for the
+    requests twice. They are only reused with the same `params`."""
+
+    def __init__(self, llm_client, folder: str, name: str, params: dict, scheduler: RequestScheduler, endpoint = '/v1/chat/completions', poll_interval = BATCH_POLL_INTERVAL):
+        self.llm_client = llm_client
+        self.folder = folder
+        self.name = name
+        self.scheduler = scheduler
+        self.endpoint = endpoint
+        self.poll_interval = poll_interval
+        self.state_path = os.path.join(folder, f'{name}.json')
+        self.state = {"params": params, "batches": [], "requests": {}}
+        self.parts = []
+        self._part = None
+        if os.path.exists(self.state_path):
+            with open(self.state_path, encoding='utf-8') as f:
+                state = json.load(f)
+            if state["params"] == params:
+                self.state = state
+            else:
+                logger.info(f"Summary parameters changed, not reusing batch job {self.state_path}")
+        os.makedirs(folder, exist_ok=True)
+
+    @property
+    def submitted(self) -> bool:
+        return bool(self.state["batches"])
+
+    @property
+    def requests(self) -> dict:
+        """The `meta` of every request by custom id, in the order they were added."""
+        return self.state["requests"]
+
+    def add(self, custom_id: str, model: str, messages: list, max_tokens: int, response_model = None, meta = None) -> None:
+        body = {"model": model, "messages": messages, "max_tokens": max_tokens}
+        if response_model:
+            body["response_format"] = response_format(response_model)
+        line = (json.dumps({"custom_id": custom_id, "method": "POST", "url": self.endpoint, "body": body}) + "\n").encode()
+        if self._part is None or self._part_requests >= BATCH_MAX_REQUESTS or self._part_bytes + len(line) > BATCH_MAX_BYTES:
+            if self._part:
+                self._part.close()
+            self.parts.append(os.path.join(self.folder, f'{self.name}_{len(self.parts)}.jsonl'))
+            self._part = open(self.parts[-1], 'wb')
+            self._part_requests = 0
+            self._part_bytes = 0
+        self._part.write(line)
+        self._part_requests += 1
+        self._part_bytes += len(line)
+        self.requests[custom_id] = meta
+
+    def submit(self) -> None:
+        """Uploads and submits the requests added so far, one batch per JSONL file."""
+        if self._part:
+            self._part.close()
+            self._part = None
+        for path in self.parts:
+            def upload():
+                with open(path, 'rb') as f:
+                    return self.llm_client.files.create(file=f, purpose='batch')
+            input_file = self.scheduler.call(upload, name='batch.upload', payload_bytes=os.path.getsize(path))
+            batch = self.scheduler.call(lambda: self.llm_client.batches.create(input_file_id=input_file.id, endpoint=self.endpoint, completion_window='24h'), name='batch.create')
+            logger.info(f"Submitted batch {batch.id} with the requests in {path}")
+            self.state["batches"].append(batch.id)
+            write_json_atomic(self.state_path, self.state)
+            os.remove(path)
+        self.parts = []
+
+    def wait(self, batch_id: str):
+        while True:
+            batch = self.scheduler.call(lambda: self.llm_client.batches.retrieve(batch_id), name='batch.poll')
+            counts = batch.request_counts
+            logger.info(f"Batch {batch_id} is {batch.status}" + (f", {counts.completed + counts.failed} of {counts.total} requests done" if counts else ""))
+            if batch.status in BATCH_FINAL:
+                return batch
+            # a cancelled run leaves the batch running; the next run picks it up
+            if self.scheduler.cancelled.wait(self.poll_interval):
+                raise Cancelled()
+
+    def download(self, batch_id: str):
+        """Waits for a batch and returns it with the response content of each of its
+        requests by custom id, None for requests that failed."""
+        with metrics.span("batch", job=self.name, id=batch_id):
+            batch = self.wait(batch_id)
+        if batch.status != "completed":
+            logger.error(f"Batch {batch_id} {batch.status}: {batch.errors}")
+        contents = {}
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if not file_id:
+                continue
+            content = self.scheduler.call(lambda: self.llm_client.files.content(file_id), name='batch.download')
+            for line in content.text.splitlines():
+                if not line.strip():
+                    continue
+                result = json.loads(line)
+                response = result.get("response") or {}
+                if response.get("status_code") == 200:
+                    contents[result["custom_id"]] = response["body"]["choices"][0]["message"]["content"]
+                else:
+                    contents[result["custom_id"]] = None
+                    logger.error(f"Request {result['custom_id']} failed: {result.get('error') or response.get('body')}")
+        return batch, contents
+
+    def results(self) -> dict:
+        """Waits for every batch of the job and returns the response content of each
+        request by custom id, None for requests that failed. A job with a batch that
+        failed, expired or was cancelled is not kept for the next run."""
+        results = dict.fromkeys(self.requests)
+        downloaded = self.state.setdefault("downloaded", {})
+        unfinished = []
+        for batch_id in self.state["batches"]:
+            if batch_id not in downloaded:
+                batch, contents = self.download(batch_id)
+                downloaded[batch_id] = {"status": batch.status, "results": contents}
+                # kept with the job, so a rerun after an interruption does not need
+                # the files deleted below
+                write_json_atomic(self.state_path, self.state)
+                # the uploaded frames and the responses are of no further use
+                for file_id in (batch.input_file_id, batch.output_file_id, batch.error_file_id):
+                    if not file_id:
+                        continue
+                    try:
+                        self.llm_client.files.delete(file_id)
+                    except Exception as e:
+                        logger.warning(f"Could not delete batch file {file_id}: {e}")
+            if downloaded[batch_id]["status"] != "completed":
+                unfinished.append(batch_id)
+            results.update(downloaded[batch_id]["results"])
+        if unfinished and os.path.exists(self.state_path):
+            # forget the job so the next run sends its requests again instead of
+            # reading the same failed or expired batches
+            logger.info(f"Dropping batch job {self.state_path}, {len(unfinished)} of its batches did not complete")
+            os.remove(self.state_path)
+        failed = sum(content is None for content in results.values())
+        if failed:
+            logger.error(f"{failed} of {len(results)} requests of batch job {self.name} failed")
+        metrics.count(f"batch.{self.name}.requests", len(results))
+        metrics.count(f"batch.{self.name}.failed", failed)
+        return results
+
+
+def parse_description(content: str) -> Description:
+    if content is None:
+        return None
+    try:
+        return Description.model_validate_json(content)
+    except ValueError as e:
+        logger.error(f"Unreadable description: {e}")
+        return None
+
+
+def generate_summaries_batch(input_json_path: str, output_json_path: str, llm_client, LLM_IMG_LIMIT = 50, max_window_bytes = 32 * 1024 * 1024, cache: SummaryCache = None, workers = 1, scheduler: RequestScheduler = None, frame_budget = None, encode_profile = 'low', progress: ProgressStream = None, index: SegmentIndex = None, model = MODEL, endpoint = '/v1/chat/completions', poll_interval = BATCH_POLL_INTERVAL) -> bool:
+    """Generates video summaries like tasks.generate_summaries, but through the Batch
+    API, for bulk ingests that can wait for results but would be held back by
+    per-minute rate limits.
+
+    Windows are described independently, as in the map-reduce mode, since every
+    description request is sent at once. Up to three batch jobs run in turn: the
+    window descriptions, the merges of scenes with several windows, and the file
+    summaries. `model` is the model, or the deployment on Azure, named in each
+    request and `endpoint` the chat completions path of the provider."""
+    params = summary_cache_params(LLM_IMG_LIMIT, frame_budget, encode_profile)
+    params["mode"] = "batch"
+    run = SummaryRun(input_json_path, params, cache, None, progress, index)
+    files = run.files
+    remaining = run.remaining
+    batch_folder = f'{run.task_folder}/batch'
+
+    scheduler = scheduler or RequestScheduler()
+    job_params = {**params, "model": model, "sources": [source_key(files[i]['absolutePath']) for i in remaining]}
+
+    def job(name):
+        return BatchJob(llm_client, batch_folder, name, job_params, scheduler, endpoint, poll_interval)
+
+    for i in remaining:
+        run.started(i)
+
+    # describe every window
+    describe = job('describe')
+    if not describe.submitted:
+        try:
+            run.prepare(workers, LLM_IMG_LIMIT, max_window_bytes, frame_budget, encode_profile)
+            for i in remaining:
+                with metrics.span("prepare", path=files[i]['absolutePath']):
+                    windows = run.windows(i) or open_frame_windows(files[i]['absolutePath'], LLM_IMG_LIMIT, max_window_bytes, frame_budget, encode_profile)
+                    for n, window in enumerate(windows):
+                        describe.add(f'describe-{i}-{n}', model, window_messages(window), 4000, Description, {"file": i, "sceneStart": window.scene_start, "end": window.end})
+        finally:
+            run.close()
+        describe.submit()
+    descriptions = describe.results()
+
+    segments = {i: [] for i in remaining}
+    ratings = {i: [] for i in remaining}
+    scene_descriptions = {}
+    # files with a failed request, which are not cached
+    failed = set()
+    for custom_id, meta in describe.requests.items():
+        i = meta["file"]
+        if not segments[i] or segments[i][-1].startTimeSec != meta["sceneStart"]:
+            segments[i].append(Segment(meta["sceneStart"], meta["sceneStart"], "filtered"))
+            scene_descriptions[(i, meta["sceneStart"])] = []
+        segments[i][-1].endTimeSec = meta["end"]
+        desc = parse_description(descriptions[custom_id])
+        if desc:
+            scene_descriptions[(i, meta["sceneStart"])].append(desc.description)
+            ratings[i].append(desc.aestheticRating)
+        else:
+            failed.add(i)
+
+    # merge the descriptions of scenes with several windows
+    merge = job('merge')
+    if not merge.submitted:
+        for i in remaining:
+            for segment in segments[i]:
+                parts = scene_descriptions[(i, segment.startTimeSec)]
+                if len(parts) > 1:
+                    merge.add(f'merge-{i}-{segment.startTimeSec}', model, merge_messages(segment, parts), 4000)
+        merge.submit()
+    merged = merge.results()
+    for i in remaining:
+        for segment in segments[i]:
+            parts = scene_descriptions[(i, segment.startTimeSec)]
+            if len(parts) == 1:
+                segment.description = parts[0]
+            elif merged.get(f'merge-{i}-{segment.startTimeSec}'):
+                segment.description = merged[f'merge-{i}-{segment.startTimeSec}']
+            elif parts:
+                failed.add(i)
+
+    # summarize every file
+    summarize = job('summarize')
+    if not summarize.submitted:
+        for i in remaining:
+            summarize.add(f'summarize-{i}', model, summary_messages(segments[i]), 4000)
+        summarize.submit()
+    whole_summaries = summarize.results()
+
+    summaries = []
+    for i, file in enumerate(files):
+        summary = run.take_cached(i)
+        if not summary:
+            whole_summary = whole_summaries.get(f'summarize-{i}')
+            summary = run.done(i, VideoSummary(VideoFile(file['absolutePath'], os.path.basename(file['name'])), whole_summary, average_rating(ratings[i]), segments[i], i not in failed and whole_summary is not None))
+        summaries.append(summary)
+
+    run.finish(output_json_path, summaries)
+    shutil.rmtree(batch_folder, ignore_errors=True)
+
+    return True
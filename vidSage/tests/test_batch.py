@@ -0,0 +1,96 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+import openai
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+
+from batch_server import BatchServer
+from cache import SummaryCache
+from media import synthesize_clip
+from tasks import summary_cache_params
+from tasks_batch import generate_summaries_batch
+
+
+class GenerateSummariesBatchTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.media = tempfile.mkdtemp()
+        cls.files = []
+        # one scene that fits a single request, and several scenes of several requests each
+        for name, seconds, cut_every in (('still.mp4', 3, None), ('cuts.mp4', 12, 4)):
+            path = os.path.join(cls.media, name)
+            synthesize_clip(path, seconds, 10, 320, 240, gop=50, cut_every=cut_every)
+            cls.files.append({'absolutePath': path, 'name': name})
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.media, ignore_errors=True)
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+        # the task keeps its files under ./tmp
+        os.chdir(self.folder)
+        with open('input.json', 'w') as f:
+            json.dump({'taskId': 'batch', 'files': self.files}, f)
+        self.cache = SummaryCache(os.path.join(self.folder, 'cache.db'))
+
+    def tearDown(self):
+        self.cache.close()
+        os.chdir(self.cwd)
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def run_batch(self, fail_every = 0) -> tuple:
+        server = BatchServer(0, 0.05, fail_every)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        client = openai.OpenAI(base_url=server.url, api_key='test')
+        generate_summaries_batch('input.json', 'output.json', client, LLM_IMG_LIMIT=3, cache=self.cache, poll_interval=0.05)
+        with open('output.json') as f:
+            return server, json.load(f)
+
+    def cached(self, i: int) -> bool:
+        params = {**summary_cache_params(3, None, 'low'), "mode": "batch"}
+        return self.cache.get_raw(self.cache.key(self.files[i]['absolutePath'], params)) is not None
+
+    def test_all_requests_succeed(self):
+        server, summaries = self.run_batch()
+
+        self.assertEqual([summary['file']['name'] for summary in summaries], ['still.mp4', 'cuts.mp4'])
+        segments = summaries[1]['segments']
+        self.assertGreater(len(segments), 1)
+        self.assertEqual([segment['endTimeSec'] for segment in segments[:-1]], [segment['startTimeSec'] for segment in segments[1:]])
+        self.assertEqual(segments[-1]['endTimeSec'], 12)
+        for i, summary in enumerate(summaries):
+            self.assertIsNotNone(summary['summary'])
+            self.assertNotIn('filtered', [segment['description'] for segment in summary['segments']])
+            self.assertTrue(self.cached(i))
+        # describe, merge of the scenes with several windows, summarize
+        self.assertEqual(len(server.batches), 3)
+        # uploads and results are deleted once read
+        self.assertEqual(server.files, {})
+        self.assertFalse(os.path.exists('tmp/batch/batch'))
+
+    def test_failed_requests_are_not_cached(self):
+        # the second request of each batch fails: a window of cuts.mp4 and its summary
+        server, summaries = self.run_batch(fail_every=2)
+
+        self.assertEqual([summary['file']['name'] for summary in summaries], ['still.mp4', 'cuts.mp4'])
+        self.assertIsNotNone(summaries[0]['summary'])
+        self.assertTrue(self.cached(0))
+        self.assertIsNone(summaries[1]['summary'])
+        self.assertFalse(self.cached(1))
+        self.assertGreater(server.batches['batch_1']['request_counts']['failed'], 0)
+        self.assertEqual(server.files, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import utils
+
+FPS = 25
+
+
+def make_source(path: str, *options, audio = True) -> None:
+    """12 seconds of moving test pattern with a tone, a keyframe every 2 seconds."""
+    command = ['ffmpeg', '-v', 'error', '-f', 'lavfi', '-i', f'testsrc2=size=320x240:rate={FPS}:duration=12']
+    if audio:
+        command.extend(['-f', 'lavfi', '-i', 'sine=frequency=440:duration=12', '-c:a', 'aac', '-shortest'])
+    command.extend(['-c:v', 'libx264', '-g', str(2 * FPS), '-keyint_min', str(2 * FPS), '-sc_threshold', '0'])
+    subprocess.run(command + list(options) + [path, '-y'], check=True)
+
+
+def read_frames(path: str) -> list:
+    video = cv2.VideoCapture(path)
+    frames = []
+    while True:
+        ret, frame = video.read()
+        if not ret:
+            break
+        frames.append(frame.astype(np.int16))
+    video.release()
+    return frames
+
+
+@unittest.skipUnless(shutil.which('ffmpeg') and shutil.which('ffprobe'), 'needs ffmpeg and ffprobe')
+class ClipVideoTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def assertFramesMatch(self, clip: list, source: list, first: int, tolerance: float) -> None:
+        for i, frame in enumerate(clip):
+            self.assertLessEqual(np.abs(frame - source[first + i]).mean(), tolerance, f"frame {i} of the clip")
+
+    def test_smart_render_keeps_each_parts_parameter_sets(self):
+        # baseline profile codes with CAVLC, libx264's head with CABAC: a tail read
+        # with the head's parameter sets does not decode
+        source = os.path.join(self.folder, 'source.mp4')
+        make_source(source, '-profile:v', 'baseline')
+        clip = os.path.join(self.folder, 'clip.mp4')
+        # starts 17 frames before the keyframe at 4 s
+        utils.clip_video(source, clip, 83 / FPS, 8.0)
+
+        frames = read_frames(clip)
+        self.assertEqual(len(frames), 200 - 83)
+        source_frames = read_frames(source)
+        # the re-encoded head is close, the copied tail exact
+        self.assertFramesMatch(frames[:17], source_frames, 83, 3)
+        self.assertFramesMatch(frames[17:], source_frames, 100, 0)
+
+    def test_keyframes_count_from_the_start_of_the_file(self):
+        # video only, as AAC priming would start the file a little before the video
+        source = os.path.join(self.folder, 'source.mp4')
+        make_source(source, '-output_ts_offset', '1.5', audio=False)
+        self.assertAlmostEqual(utils.probe_media(source).start_time, 1.5)
+        self.assertEqual(utils.keyframes_in(source, 3.0, 7.0), [2.0, 4.0, 6.0])
+
+        clip = os.path.join(self.folder, 'clip.mp4')
+        # on a keyframe, so copied without re-encoding
+        utils.clip_video(source, clip, 4.0, 6.0)
+        frames = read_frames(clip)
+        # a stream copy may run a few frames past the end to complete B-frame groups
+        self.assertGreaterEqual(len(frames), 2 * FPS)
+        self.assertFramesMatch(frames[:2 * FPS], read_frames(source), 4 * FPS, 0)
+
+
+@unittest.skipUnless(shutil.which('ffmpeg') and shutil.which('ffprobe'), 'needs ffmpeg and ffprobe')
+class RenderRangesTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def test_ranges_are_copied_from_the_start_of_the_file(self):
+        source = os.path.join(self.folder, 'source.mp4')
+        make_source(source, '-output_ts_offset', '1.5', audio=False)
+        output = os.path.join(self.folder, 'output.mp4')
+        utils.render_ranges([(source, 4.0, 6.0), (source, 8.0, 10.0)], output, self.folder)
+
+        frames = read_frames(output)
+        source_frames = read_frames(source)
+        self.assertEqual(np.abs(frames[0] - source_frames[4 * FPS]).max(), 0)
+        self.assertIn(f"inpoint {4.0 + 1.5}", open(os.path.join(self.folder, 'vid_list.txt')).read())
+
+    def test_reencoding_shares_inputs_and_fits_portrait_sources(self):
+        landscape = os.path.join(self.folder, 'landscape.mp4')
+        make_source(landscape)
+        # recorded the way phones do: landscape pixels with a display rotation
+        portrait = os.path.join(self.folder, 'portrait.mp4')
+        subprocess.run(['ffmpeg', '-v', 'error', '-display_rotation', '90', '-i', landscape, '-c', 'copy', portrait, '-y'], check=True)
+        output = os.path.join(self.folder, 'output.mp4')
+        ranges = [(portrait, 1.0, 2.0), (landscape, 1.0, 2.0), (portrait, 3.0, 4.0), (landscape, 0.0, 1.0)]
+        utils.render_ranges(ranges, output, self.folder, stream_copy=False)
+
+        frames = read_frames(output)
+        self.assertEqual(len(frames), 4 * FPS)
+        self.assertEqual(frames[0].shape[:2], (320, 240))
+        # the portrait ranges read one input; the landscape range that goes back opens a second
+        script = open(os.path.join(self.folder, 'filters.txt')).read()
+        self.assertIn('[0:v:0]split=2', script)
+        self.assertIn('[2:v:0]split=1', script)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,36 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from scenedetect import HashDetector
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+
+from media import synthesize_clip
+from tasks import SCENE_THRESHOLD
+from utils import scan_video
+
+
+class SceneDetectionTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def test_scenes_do_not_depend_on_the_source_frame_rate(self):
+        # 8 second scenes are longer than min_scene_len (15 frames at 2 fps), also
+        # when a 1 fps source gives the detector fewer frames than that
+        for fps in (1, 30):
+            with self.subTest(fps=fps):
+                path = os.path.join(self.folder, f'{fps}.mp4')
+                synthesize_clip(path, 20, fps, 320, 240, gop=5 * fps, cut_every=8)
+                _, scenes = scan_video(path, HashDetector(threshold=SCENE_THRESHOLD))
+                self.assertEqual(scenes, [(0, 8), (8, 16), (16, 20)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+import email.utils
+import os
+import sys
+import time
+import unittest
+
+import httpx
+import openai
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from scheduler import CONTENT_FILTER, FATAL, RATE_LIMIT, RETRYABLE, TokenBucket, classify_error, retry_after_seconds
+
+REQUEST = httpx.Request('POST', 'https://example.invalid/v1/chat/completions')
+
+
+def new_bucket(per_minute: float) -> TokenBucket:
+    bucket = TokenBucket(per_minute)
+    # the tests keep their own clock, starting at 0
+    bucket.updated = 0.0
+    return bucket
+
+
+def sent_within(bucket: TokenBucket, cost: float, seconds: float) -> float:
+    """Sends requests of `cost` back to back, each as soon as the bucket allows, and
+    returns the tokens sent in the first `seconds`."""
+    now = 0.0
+    sent = 0.0
+    while True:
+        now += bucket.reserve(cost, now)
+        if now >= seconds:
+            return sent
+        sent += cost
+
+
+class TokenBucketTest(unittest.TestCase):
+    def test_burst_is_not_delayed(self):
+        bucket = new_bucket(60)
+        # 10 seconds of budget at one request per second
+        self.assertEqual([bucket.reserve(1, 0.0) for _ in range(10)], [0.0] * 10)
+        self.assertAlmostEqual(bucket.reserve(1, 0.0), 1.0)
+
+    def test_refill_covers_waits(self):
+        bucket = new_bucket(60)
+        for _ in range(10):
+            bucket.reserve(1, 0.0)
+        self.assertAlmostEqual(bucket.reserve(1, 5.0), 0.0)
+        self.assertAlmostEqual(bucket.reserve(1, 5.0), 0.0)
+
+    def test_requests_bigger_than_the_burst_are_charged_in_full(self):
+        # a default describe request: 4000 max_tokens and 50 low detail frames
+        cost = 4000 + 50 * 85
+        bucket = new_bucket(30000)
+        self.assertAlmostEqual(bucket.reserve(cost, 0.0), (cost - bucket.capacity) / bucket.rate)
+        self.assertAlmostEqual(bucket.reserve(cost, 0.0), (2 * cost - bucket.capacity) / bucket.rate)
+
+    def test_minute_stays_within_limit(self):
+        cost = 4000 + 50 * 85
+        for per_minute in (30000, 100000, 1000000):
+            bucket = new_bucket(per_minute)
+            # at most the burst on top of one minute of budget
+            self.assertLessEqual(sent_within(bucket, cost, 60), per_minute + bucket.capacity)
+
+
+def status_error(error_class, status: int, headers = None, body = None) -> openai.APIStatusError:
+    response = httpx.Response(status, headers=headers or {}, request=REQUEST)
+    return error_class(f"Error code: {status}", response=response, body=body)
+
+
+class ClassifyErrorTest(unittest.TestCase):
+    def test_content_filter(self):
+        self.assertEqual(classify_error(openai.ContentFilterFinishReasonError()), CONTENT_FILTER)
+        # Azure rejects the prompt itself with a 400 carrying the filter code
+        error = status_error(openai.BadRequestError, 400, body={'code': 'content_filter', 'message': 'filtered'})
+        self.assertEqual(classify_error(error), CONTENT_FILTER)
+
+    def test_other_bad_requests_are_fatal(self):
+        error = status_error(openai.BadRequestError, 400, body={'code': 'invalid_image', 'message': 'bad image'})
+        self.assertEqual(classify_error(error), FATAL)
+        self.assertEqual(classify_error(status_error(openai.AuthenticationError, 401)), FATAL)
+
+    def test_rate_limit(self):
+        self.assertEqual(classify_error(status_error(openai.RateLimitError, 429)), RATE_LIMIT)
+
+    def test_timeouts_and_server_errors_are_retried(self):
+        self.assertEqual(classify_error(openai.APITimeoutError(request=REQUEST)), RETRYABLE)
+        self.assertEqual(classify_error(status_error(openai.InternalServerError, 503)), RETRYABLE)
+        self.assertEqual(classify_error(status_error(openai.APIStatusError, 408)), RETRYABLE)
+
+
+class RetryAfterTest(unittest.TestCase):
+    def wait(self, headers: dict) -> float:
+        return retry_after_seconds(status_error(openai.RateLimitError, 429, headers))
+
+    def test_seconds_and_milliseconds(self):
+        self.assertEqual(self.wait({'retry-after': '7'}), 7.0)
+        self.assertEqual(self.wait({'retry-after-ms': '1500', 'retry-after': '7'}), 1.5)
+
+    def test_http_date(self):
+        date = email.utils.formatdate(time.time() + 30, usegmt=True)
+        self.assertAlmostEqual(self.wait({'retry-after': date}), 30, delta=2)
+        # a date in the past means retry now
+        self.assertEqual(self.wait({'retry-after': email.utils.formatdate(time.time() - 30, usegmt=True)}), 0)
+
+    def test_malformed_header_falls_back(self):
+        self.assertIsNone(self.wait({'retry-after': 'soon'}))
+        self.assertIsNone(self.wait({'retry-after-ms': 'soon'}))
+        # the rate-limit reset headers still count
+        self.assertEqual(self.wait({'retry-after': 'soon', 'x-ratelimit-remaining-requests': '0', 'x-ratelimit-reset-requests': '6m0s'}), 360)
+
+    def test_reset_headers_only_when_exhausted(self):
+        headers = {'x-ratelimit-remaining-tokens': '0', 'x-ratelimit-reset-tokens': '1.5s', 'x-ratelimit-reset-requests': '20ms'}
+        self.assertEqual(self.wait(headers), 1.5)
+        headers['x-ratelimit-remaining-tokens'] = '10'
+        self.assertIsNone(self.wait(headers))
+
+    def test_without_a_response(self):
+        self.assertIsNone(retry_after_seconds(openai.APITimeoutError(request=REQUEST)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,12 +2,22 @@ import json
 from typing import Any
 import shutil
 import cv2
+import numpy as np
+from scenedetect import HashDetector, StatsManager
 import base64
+import bisect
 import os
 import subprocess
 import sys
+import tempfile
+import threading
+import time
 import logging
 
+import metrics
+from videoObjects import FrameWindow
+from scheduler import image_tokens
+
 logger = logging.getLogger(__name__)
 
 def read_json_file(file_path: str) -> Any:
@@ -19,45 +29,232 @@ def write_json_file(file_path: str, data: Any) -> None:
     with open(file_path, 'w', encoding='utf-8') as file:
         json.dump(data, file, indent=4)
 
-def preprocess_video(input_vid_path: str, output_vid_path: str, fps=2, height=720, silent=True) -> None:
-    """Preprocesses a video file to reduce its size and frame rate."""
+# encoders that can re-encode the head of a clip so it splices onto stream-copied
+# source; only H.264 parts get their parameter sets moved in-band by the concat
+# demuxer, so HEVC ranges are re-encoded whole
+SMART_RENDER_ENCODERS = {'h264': 'libx264'}
+
+_media_index = {}
+_media_index_lock = threading.Lock()
+
+def run_ffmpeg(command: list, silent=True) -> None:
+    if silent:
+        command = command + ["-nostats", "-loglevel", "0"]
+    subprocess.run(command, check=True)
+
+def require_tools(*tools) -> None:
+    """Raises FileNotFoundError naming the first of `tools` that is not on PATH."""
+    for tool in tools:
+        if not shutil.which(tool):
+            logger.error(f"{tool} not found on the system.")
+            raise FileNotFoundError(f"{tool} not found on the system.")
+
+class MediaInfo:
+    """What ffprobe reads from a source file's header: duration and start time, the
+    exact frame rate and codec parameters of the first video stream, and the first
+    audio stream if any."""
+
+    def __init__(self, path: str, duration: float, video: dict, audio: dict = None, start_time = 0.0):
+        self.path = path
+        self.duration = duration
+        # timestamp of the first frame; ffmpeg's -ss counts from here, packet times do not
+        self.start_time = start_time
+        self.video = video
+        self.audio = audio
+
+    @property
+    def fps(self) -> str:
+        """Frame rate as an exact ffmpeg rational such as "30000/1001"."""
+        for rate in (self.video.get('avg_frame_rate'), self.video.get('r_frame_rate')):
+            if rate and rate not in ('0/0', '0'):
+                return rate
+        return None
+
+    @property
+    def has_audio(self) -> bool:
+        return self.audio is not None
+
+    @property
+    def display_size(self) -> tuple:
+        """Width and height as shown, which ffmpeg also decodes to: the coded size
+        turned by the display rotation that phones record portrait video with."""
+        width, height = self.video['width'], self.video['height']
+        if self.video.get('rotation', 0) % 180:
+            return height, width
+        return width, height
+
+    def stream_copy_signature(self) -> tuple:
+        """Everything that must match for streams to be joined by copying packets."""
+        video = tuple(self.video.get(field) for field in ('codec_name', 'profile', 'pix_fmt', 'width', 'height', 'time_base', 'rotation'))
+        audio = tuple(self.audio.get(field) for field in ('codec_name', 'sample_rate', 'channels')) if self.audio else None
+        return video, audio
+
+    def to_dict(self):
+        return {
+            "path": self.path,
+            "duration": self.duration,
+            "startTime": self.start_time,
+            "video": self.video,
+            "audio": self.audio
+        }
+
+    @staticmethod
+    def from_dict(data: dict):
+        return MediaInfo(data["path"], data["duration"], data["video"], data.get("audio"), data.get("startTime", 0.0))
+
+def _rotation(stream: dict) -> int:
+    """Display rotation of a stream in degrees, from its display matrix or, in older
+    files, its rotate tag."""
+    for side_data in stream.get('side_data_list', []):
+        if 'rotation' in side_data:
+            return int(float(side_data['rotation'])) % 360
+    return int(float(stream.get('tags', {}).get('rotate', 0))) % 360
+
+def _parse_compact(line: str) -> tuple:
+    section, _, fields = line.partition('|')
+    return section, dict(field.split('=', 1) for field in fields.split('|') if '=' in field)
+
+def probe_media(video_path: str) -> MediaInfo:
+    """Probes a source file's header once and keeps the result for as long as its
+    path, mtime and size are unchanged, so every stage of a run (and every command
+    of `serve`) shares one probe per file. No packets are read, so this is quick
+    however long the file is; see keyframes_in for the keyframes of a range."""
+    stat = os.stat(video_path)
+    key = (os.path.abspath(video_path), stat.st_mtime, stat.st_size)
+    with _media_index_lock:
+        if key in _media_index:
+            metrics.count("probe.hits")
+            return _media_index[key]
+
+    with metrics.span("probe", path=key[0]):
+        result = subprocess.run([
+            'ffprobe', "-v", "error",
+            "-show_entries",
+            "format=duration,start_time"
+            ":stream=index,codec_type,codec_name,profile,pix_fmt,width,height,avg_frame_rate,r_frame_rate,time_base,sample_rate,channels"
+            ":stream_tags=rotate:stream_side_data=rotation",
+            "-of", "json",
+            video_path
+        ], stdout=subprocess.PIPE, check=True)
+    metrics.count("probe.misses")
+
+    probed = json.loads(result.stdout.decode())
+    format = probed.get('format', {})
+    duration = float(format['duration']) if format.get('duration') not in (None, 'N/A') else 0.0
+    start_time = float(format['start_time']) if format.get('start_time') not in (None, 'N/A') else 0.0
+    streams = probed.get('streams', [])
+
+    video = next((stream for stream in streams if stream.get('codec_type') == 'video'), {})
+    audio = next((stream for stream in streams if stream.get('codec_type') == 'audio'), None)
+    if video:
+        video['rotation'] = _rotation(video)
+        video.pop('side_data_list', None)
+        video.pop('tags', None)
+    if audio and audio.get('sample_rate') not in (None, 'N/A'):
+        audio['sample_rate'] = int(audio['sample_rate'])
+
+    info = MediaInfo(key[0], duration, video, audio, start_time)
+    with _media_index_lock:
+        _media_index[key] = info
+    return info
 
+def keyframes_in(video_path: str, start_time: float, end_time: float) -> list:
+    """Sorted keyframe times of the video stream from the keyframe at or before
+    `start_time` up to `end_time`. ffprobe seeks to the range and demuxes only its
+    packets, so the cost follows the length of the range, not of the file.
+
+    Times are counted from the start of the file, like ffmpeg's -ss, whereas
+    ffprobe reads and reports packet timestamps as they are stored."""
+    offset = probe_media(video_path).start_time
+    with metrics.span("keyframes", path=video_path, start=start_time, end=end_time):
+        result = subprocess.run([
+            'ffprobe', "-v", "error",
+            "-select_streams", "v:0",
+            "-read_intervals", f"{start_time + offset}%{end_time + offset}",
+            "-show_entries", "packet=pts_time,flags",
+            "-of", "compact",
+            video_path
+        ], stdout=subprocess.PIPE, check=True)
+    keyframes = []
+    for line in result.stdout.decode().splitlines():
+        section, fields = _parse_compact(line)
+        if section == 'packet' and 'K' in fields.get('flags', '') and fields.get('pts_time') not in (None, '', 'N/A'):
+            keyframes.append(round(float(fields['pts_time']) - offset, 6))
+    return sorted(keyframes)
+
+def copy_range(input_vid_path: str, output_vid_path: str, start_time: float, end_time: float, audio_codec='copy', silent=True) -> None:
+    """Stream-copies a range with input-side seeking; `start_time` should be a keyframe."""
     command = [
         'ffmpeg',
+        "-ss", str(start_time),
         "-i", input_vid_path,
-        "-vf", f"scale=-2:{height}",
-        "-r", str(fps),
-        "-preset", "ultrafast",
-        "-an",
+        "-t", str(end_time - start_time),
+        "-map", "0:v:0", "-map", "0:a?",
+        "-c:v", "copy",
+        "-c:a", audio_codec,
+        "-avoid_negative_ts", "make_zero",
         output_vid_path,
         "-y"
     ]
-    if silent:
-        command.extend(["-nostats", "-loglevel", "0"])
-
-    subprocess.run(command)
-
-def clip_video(input_vid_path: str, output_vid_path: str, start_time: int, end_time: int, silent=True) -> None:
-    """Clips a video file."""
-    if not shutil.which("ffmpeg"):
-        logger.error("ffmpeg not found on the system.")
-        raise FileNotFoundError("ffmpeg not found on the system.")
+    with metrics.span("copyRange", path=input_vid_path, start=start_time, end=end_time):
+        run_ffmpeg(command, silent)
 
+def encode_range(input_vid_path: str, output_vid_path: str, start_time: float, end_time: float, encoder='libx264', pix_fmt=None, silent=True) -> None:
+    """Re-encodes a range, frame-accurately, with input-side seeking."""
     command = [
         'ffmpeg',
-        "-i", input_vid_path,
         "-ss", str(start_time),
-        "-to", str(end_time),
-        "-c", "copy",
-        output_vid_path,
-        "-y"
+        "-i", input_vid_path,
+        "-t", str(end_time - start_time),
+        "-map", "0:v:0", "-map", "0:a?",
+        # keep the source's frame timing; a constant rate would duplicate a frame at a
+        # start that falls between two frames
+        "-fps_mode", "passthrough",
+        "-c:v", encoder, "-preset", "veryfast", "-crf", "18",
+        "-c:a", "aac"
     ]
-    if silent:
-        command.extend(["-nostats", "-loglevel", "0"])
+    if pix_fmt:
+        command.extend(["-pix_fmt", pix_fmt])
+    with metrics.span("encodeRange", path=input_vid_path, start=start_time, end=end_time, encoder=encoder):
+        run_ffmpeg(command + [output_vid_path, "-y"], silent)
+
+def clip_video(input_vid_path: str, output_vid_path: str, start_time: int, end_time: int, silent=True) -> None:
+    """Clips a video file, frame-accurately and without reading the source from the start.
+
+    Seeks on the input side and stream-copies from the first keyframe at or after
+    `start_time`; only the partial GOP before that keyframe is re-encoded and
+    spliced in front (smart rendering). Sources in codecs we cannot re-encode to
+    match, or ranges without a keyframe, are re-encoded whole."""
+    require_tools("ffmpeg", "ffprobe")
 
-    subprocess.run(command)
+    stream = probe_media(input_vid_path).video
+    encoder = SMART_RENDER_ENCODERS.get(stream.get('codec_name'))
+    keyframes = keyframes_in(input_vid_path, start_time, end_time)
+    # tolerate timestamps that are a rounding error before the keyframe
+    i = bisect.bisect_left(keyframes, start_time - 0.001)
+    keyframe = keyframes[i] if i < len(keyframes) else None
 
-def concat_videos(input_list_path: str, output_vid_path: str, silent=True) -> None:
+    if keyframe is not None and keyframe - start_time < 0.001:
+        copy_range(input_vid_path, output_vid_path, start_time, end_time, silent=silent)
+        return
+    if encoder is None or keyframe is None or keyframe >= end_time:
+        encode_range(input_vid_path, output_vid_path, start_time, end_time, encoder or 'libx264', stream.get('pix_fmt'), silent)
+        return
+
+    # the head and the tail come from different encoders, so their SPS/PPS differ.
+    # The concat demuxer puts each part's parameter sets in-band in front of its
+    # keyframes, and the avc3 sample entry tells players to use those instead of the
+    # single set stored in the MP4 header (which an avc1 entry would require)
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(output_vid_path))) as tmp_folder:
+        head = os.path.join(tmp_folder, 'head.mp4')
+        tail = os.path.join(tmp_folder, 'tail.mp4')
+        encode_range(input_vid_path, head, start_time, keyframe, encoder, stream.get('pix_fmt'), silent)
+        copy_range(input_vid_path, tail, keyframe, end_time, 'aac', silent)
+        with open(os.path.join(tmp_folder, 'parts.txt'), 'w') as f:
+            f.write(f"file '{head}'\nfile '{tail}'\n")
+        concat_videos(os.path.join(tmp_folder, 'parts.txt'), output_vid_path, silent, video_tag='avc3')
+
+def concat_videos(input_list_path: str, output_vid_path: str, silent=True, video_tag=None) -> None:
     """Concatenates multiple video files."""
 
     command = [
@@ -65,47 +262,426 @@ def concat_videos(input_list_path: str, output_vid_path: str, silent=True) -> No
         "-f", "concat",
         "-safe", "0",
         "-i", input_list_path,
-        "-c", "copy",
-        output_vid_path,
-        "-y"
+        "-c", "copy"
     ]
+    if video_tag:
+        command.extend(["-tag:v", video_tag])
+    command.extend([output_vid_path, "-y"])
+    with metrics.span("concat", output=output_vid_path):
+        run_ffmpeg(command, silent)
 
-    if silent:
-        command.extend(["-nostats", "-loglevel", "0"])
 
-    subprocess.run(command)
+def render_ranges(ranges: list, output_vid_path: str, work_folder: str, stream_copy=True, silent=True) -> None:
+    """Renders (source path, start, end) ranges into one video, reading each range
+    straight from its source.
 
+    By default the ranges are listed with inpoint and outpoint for the concat
+    demuxer and their packets copied, which cuts at keyframes as joining clips did.
+    Without `stream_copy`, or when the sources' codec parameters differ so their
+    packets could not be joined, the ranges are trimmed frame-accurately, fitted to
+    the first source's displayed size and frame rate and joined with the concat
+    filter in a single encode. The concat list or filter graph is written to
+    `work_folder`, keeping the command line short however many ranges there are."""
+    require_tools("ffmpeg", "ffprobe")
+    if not ranges:
+        raise ValueError("No video ranges to render.")
+
+    infos = {path: probe_media(path) for path, _, _ in ranges}
+    if stream_copy and len({info.stream_copy_signature() for info in infos.values()}) > 1:
+        logger.warning("Sources differ in codec parameters, encoding instead of stream copying.")
+        stream_copy = False
+
+    if stream_copy:
+        list_path = os.path.join(work_folder, 'vid_list.txt')
+        with open(list_path, 'w') as f:
+            for path, start, end in ranges:
+                # inpoint and outpoint are packet timestamps, which start at start_time
+                offset = infos[path].start_time
+                path = os.path.abspath(path).replace("'", "'\\''")
+                f.write(f"file '{path}'\ninpoint {start + offset}\noutpoint {end + offset}\n")
+        # sources encoded with other settings have other SPS/PPS; see clip_video
+        video_tag = 'avc3' if len(infos) > 1 and infos[ranges[0][0]].video.get('codec_name') == 'h264' else None
+        concat_videos(list_path, output_vid_path, silent, video_tag)
+        return
+
+    # ranges of a source that follow each other in time share one input, decoded in
+    # one pass from the first one's start; a range that goes back opens another
+    inputs = []
+    range_inputs = []
+    latest = {}
+    for path, start, end in ranges:
+        k = latest.get(path)
+        if k is None or start < inputs[k][2]:
+            k = latest[path] = len(inputs)
+            inputs.append([path, start, end])
+        inputs[k][2] = max(inputs[k][2], end)
+        range_inputs.append(k)
+
+    first = infos[ranges[0][0]]
+    width, height = first.display_size
+    fps = first.fps or '30'
+    filters = []
+    for k, (path, _, _) in enumerate(inputs):
+        uses = [i for i, input in enumerate(range_inputs) if input == k]
+        filters.append(f"[{k}:v:0]split={len(uses)}" + ''.join(f"[s{i}]" for i in uses))
+        if infos[path].has_audio:
+            filters.append(f"[{k}:a:0]asplit={len(uses)}" + ''.join(f"[t{i}]" for i in uses))
+    for i, (path, start, end) in enumerate(ranges):
+        # an input seeked with -ss starts at timestamp 0
+        base = inputs[range_inputs[i]][1]
+        filters.append(f"[s{i}]trim=start={start - base}:end={end - base},setpts=PTS-STARTPTS,scale={width}:{height}:force_original_aspect_ratio=decrease,pad={width}:{height}:(ow-iw)/2:(oh-ih)/2,setsar=1,fps={fps},format=yuv420p[v{i}]")
+        if infos[path].has_audio:
+            filters.append(f"[t{i}]atrim=start={start - base}:end={end - base},asetpts=PTS-STARTPTS,aresample=48000,aformat=channel_layouts=stereo[a{i}]")
+        else:
+            filters.append(f"anullsrc=r=48000:cl=stereo,atrim=duration={end - start}[a{i}]")
+    joined = ''.join(f"[v{i}][a{i}]" for i in range(len(ranges)))
+    filters.append(f"{joined}concat=n={len(ranges)}:v=1:a=1[v][a]")
+    script_path = os.path.join(work_folder, 'filters.txt')
+    with open(script_path, 'w') as f:
+        f.write(';\n'.join(filters))
+
+    command = ['ffmpeg']
+    for path, start, end in inputs:
+        command.extend(["-ss", str(start), "-t", str(end - start), "-i", path])
+    command.extend([
+        "-filter_complex_script", script_path,
+        "-map", "[v]", "-map", "[a]",
+        "-c:v", "libx264", "-preset", "veryfast", "-crf", "18",
+        "-c:a", "aac",
+        output_vid_path,
+        "-y"
+    ])
+    with metrics.span("render", ranges=len(ranges), inputs=len(inputs), output=output_vid_path):
+        run_ffmpeg(command, silent)
 
 def extract_frames_fixed(video_path, interval = 1):
+    """Samples one frame every `interval` seconds, reading the video sequentially."""
+    frames, _ = scan_video(video_path, interval=interval)
+    return frames
+
+class MotionSampler:
+    """Spreads a per-file budget of frames over the candidate frames of a video in
+    proportion to how much the picture changes, so static stretches get few frames
+    and fast action gets many.
+
+    Each candidate weighs its motion (hash distance to the previous candidate) plus
+    `min_weight`. A frame is kept once the weight gathered since the last kept frame
+    reaches the share of the remaining weight that one frame of the remaining budget
+    has to cover, or when `max_gap` seconds passed without one."""
+
+    def __init__(self, budget: int, candidates: int, min_weight = 0.05, max_gap = 10):
+        self.budget = budget
+        self.candidates = candidates
+        self.min_weight = min_weight
+        self.max_gap = max_gap
+        self.seen = 0
+        self.kept = 0
+        self.total_weight = 0.0
+        self.weight = 0.0
+        self.last_kept = None
+
+    def keep(self, t: float, motion: float) -> bool:
+        """`motion` is None for the first candidate, which is always kept."""
+        self.seen += 1
+        if self.kept >= self.budget:
+            return False
+        if motion is not None:
+            weight = motion + self.min_weight
+            self.total_weight += weight
+            self.weight += weight
+            remaining = max(self.candidates - self.seen, 0) + 1
+            quantum = self.total_weight / self.seen * remaining / (self.budget - self.kept)
+            if self.weight < quantum and t - self.last_kept < self.max_gap:
+                return False
+        self.kept += 1
+        self.weight = 0.0
+        self.last_kept = t
+        return True
+
+def decode_video(video_path: str, detector=None, interval=1, detect_fps=2, detect_height=720, frame_budget=None):
+    """Decodes a video once, in order. Yields ("frame", t, frame) for every frame
+    sampled at `interval` seconds, ("cut", t) for every scene cut found by
+    `detector`, and a final ("end", t) with the duration. Times are in seconds.
+
+    With `frame_budget`, frames are instead picked by a MotionSampler among the
+    frames decimated to `detect_fps`, using the same hash distance the detector
+    computes for cuts, and at most `frame_budget` frames are yielded."""
     video = cv2.VideoCapture(video_path)
-    frames = []
     fps = video.get(cv2.CAP_PROP_FPS)
-    #get frames at fixed interval in seconds
-    frame_interval = int(fps) * interval
-    count = 0
-
-    total_frames = int(video.get(cv2.CAP_PROP_FRAME_COUNT))
-    for i in range(0, total_frames, frame_interval):
-        video.set(cv2.CAP_PROP_POS_FRAMES, i)
-        ret, frame = video.read()
-        if ret:
-            frames.append(frame)
-            count += 1
-
-    video.release()
-    return frames
+    # pick the frame nearest to each target timestamp rather than the first one after it
+    half_frame = 0.5 / fps if fps > 0 else 0
+
+    sampler = None
+    metric = None
+    if frame_budget:
+        # from the capture rather than ffprobe, so summaries need nothing beyond OpenCV
+        duration = video.get(cv2.CAP_PROP_FRAME_COUNT) / fps if fps > 0 else 0
+        sampler = MotionSampler(frame_budget, int(duration * detect_fps))
+        if detector is not None:
+            # HashDetector records the distance it compares against its threshold here
+            if detector.stats_manager is None:
+                detector.stats_manager = StatsManager()
+            metric = detector.get_metrics()[0]
+    last_hash = None
+
+    detect_idx = 0
+    # the time each detector frame stands for, as cuts are reported as detector frame numbers
+    detect_times = []
+    next_sample = 0.0
+    next_detect = 0.0
+    t = 0.0
+    # summed locally and reported once, as frames are too many to time one by one
+    grabbed = 0
+    decode_seconds = 0.0
+    detect_seconds = 0.0
+    try:
+        # read strictly in order: grab() every frame, retrieve() only the ones we keep
+        while True:
+            started = time.perf_counter()
+            if not video.grab():
+                break
+            decode_seconds += time.perf_counter() - started
+            grabbed += 1
+            t = video.get(cv2.CAP_PROP_POS_MSEC) / 1000 + half_frame
+            sample = sampler is None and t >= next_sample
+            # decimate to detect_fps for the detector, as the old preprocessing pass did
+            candidate = (detector is not None or sampler is not None) and t >= next_detect
+            if not (sample or candidate):
+                continue
+            started = time.perf_counter()
+            ret, frame = video.retrieve()
+            decode_seconds += time.perf_counter() - started
+            if not ret:
+                break
+            if candidate:
+                started = time.perf_counter()
+                candidate_t = next_detect
+                cuts = []
+                small = frame
+                height, width = frame.shape[:2]
+                if height > detect_height:
+                    small = cv2.resize(frame, (int(width * detect_height / height), detect_height), interpolation=cv2.INTER_AREA)
+                motion = None
+                if detector is not None:
+                    # a source below detect_fps has its frame repeated for every target
+                    # it covers, as the old `-r` preprocessing did, so the detector's
+                    # min_scene_len still counts frames at detect_fps
+                    first_idx = detect_idx
+                    while next_detect <= t:
+                        detect_times.append(round(next_detect, 3))
+                        cuts.extend(detector.process_frame(detect_idx, small))
+                        detect_idx += 1
+                        next_detect += 1 / detect_fps
+                    if metric:
+                        motion = detector.stats_manager.get_metrics(first_idx, [metric])[0]
+                else:
+                    hashed = frame_hash(small)
+                    motion = hash_distance(hashed, last_hash) if last_hash is not None else None
+                    last_hash = hashed
+                    detect_times.append(round(candidate_t, 3))
+                    detect_idx += 1
+                    while next_detect <= t:
+                        next_detect += 1 / detect_fps
+                detect_seconds += time.perf_counter() - started
+                for cut in cuts:
+                    yield "cut", detect_times[cut]
+                if sampler is not None and sampler.keep(candidate_t, motion):
+                    yield "frame", round(candidate_t, 3), frame
+            if sample:
+                yield "frame", next_sample, frame
+                while next_sample <= t:
+                    next_sample += interval
+    finally:
+        video.release()
+        metrics.add_time("decode", decode_seconds, grabbed)
+        metrics.add_time("sceneDetection", detect_seconds, detect_idx)
+
+    if sampler is not None:
+        logger.info(f"Motion sampling kept {sampler.kept} of {sampler.seen} candidate frames (budget {frame_budget}) for {video_path}")
+    if detector is not None:
+        for cut in detector.post_process(detect_idx):
+            yield "cut", detect_times[cut] if cut < len(detect_times) else round(next_detect, 3)
+        yield "end", round(next_detect, 3)
+    else:
+        yield "end", round(t + half_frame, 3)
+
+def scan_video(video_path: str, detector=None, interval=1, detect_fps=2, detect_height=720):
+    """Decodes a video once, sampling a frame every `interval` seconds and feeding
+    scene detection from the same pass. Returns the sampled frames and the detected
+    scenes as (start, end) pairs in seconds."""
+    frames = []
+    cuts = []
+    duration = 0
+    for event in decode_video(video_path, detector, interval, detect_fps, detect_height):
+        if event[0] == "frame":
+            frames.append(event[2])
+        elif event[0] == "cut":
+            cuts.append(int(event[1]))
+        else:
+            duration = int(event[1])
+
+    scenes = []
+    # same convention as scenedetect: no cuts means no scene list
+    if cuts:
+        bounds = [0] + cuts + [duration]
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            scenes.append((start, end))
+
+    return frames, scenes
+
+def frame_hash(frame, size=16, lowpass=2):
+    """Perceptual hash of a frame, the same one HashDetector compares for scene cuts."""
+    return HashDetector.hash_frame(frame, size, lowpass)
+
+def hash_distance(a, b) -> float:
+    """Normalized hamming distance between two frame hashes: 0 is identical, 1 uncorrelated."""
+    return np.count_nonzero(a != b) / a.size
+
+class EncodeProfile:
+    """How frames are resized and encoded for upload. The resolution is matched to
+    what the provider keeps at the given detail level: low detail images are shrunk
+    to fit 512x512, high detail ones to a short side of 768."""
+
+    def __init__(self, name: str, width: int, height: int, detail = 'low', format = 'jpeg', quality = 80):
+        self.name = name
+        self.width = width
+        self.height = height
+        self.detail = detail
+        self.format = format
+        self.quality = quality
+        self.mime = f'image/{format}'
+        self.image_tokens = image_tokens(width, height, detail)
+
+    def resize(self, frame):
+        return cv2.resize(frame, (self.width, self.height), interpolation=cv2.INTER_AREA)
+
+    def encode(self, frame) -> str:
+        """Encodes an already resized frame as base64."""
+        if self.format == 'webp':
+            params = [cv2.IMWRITE_WEBP_QUALITY, self.quality]
+        else:
+            params = [cv2.IMWRITE_JPEG_QUALITY, self.quality]
+        _, buffer = cv2.imencode(f'.{self.format}', frame, params)
+        return base64.b64encode(buffer).decode('utf-8')
+
+    def payload_bytes(self, encoded: str) -> int:
+        """Bytes one encoded frame adds to the request body, as an image_url part."""
+        return len(encoded) + len(self.mime) + 80
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "size": [self.width, self.height],
+            "detail": self.detail,
+            "format": self.format,
+            "quality": self.quality
+        }
+
+ENCODE_PROFILES = {
+    profile.name: profile for profile in [
+        EncodeProfile('low', 512, 288),
+        EncodeProfile('low_webp', 512, 288, format='webp', quality=75),
+        EncodeProfile('high', 1366, 768, detail='high', quality=85),
+    ]
+}
+
+def iter_frame_windows(video_path: str, detector=None, window_size=50, interval=1, profile: EncodeProfile = ENCODE_PROFILES['low'], max_window_bytes=32 * 1024 * 1024, max_window_tokens=None, dedup_threshold=None, frame_budget=None):
+    """Streams a video as windows of base64 encoded frames, one scene at a time.
+
+    Frames are resized and encoded with `profile` as soon as they are decoded. A
+    window is closed before it would exceed `window_size` frames, `max_window_bytes`
+    of request payload or `max_window_tokens` image tokens, as estimated by the
+    profile, so at most one window is held in memory regardless of the video length.
+
+    With `dedup_threshold`, a frame whose hash distance to the last kept frame of
+    its scene is below the threshold is dropped before encoding. Kept frames keep
+    their own timestamps in FrameWindow.timestamps.
+
+    With `frame_budget`, frames are sampled by motion instead of every `interval`
+    seconds (see decode_video), so their spacing varies within a window."""
+    scene_start = 0
+    window = FrameWindow(scene_start, 0, profile=profile.name)
+    window_bytes = 0
+    # frames that a cut reported later in the pass could still move to the next scene
+    pending = []
+    last_hash = None
+    sampled = 0
+    kept = 0
+    encode_seconds = 0.0
+
+    def settle(until):
+        nonlocal window, window_bytes, last_hash, kept, encode_seconds
+        while pending and pending[0][0] < until:
+            ts, frame, hashed = pending.pop(0)
+            if hashed is not None:
+                if last_hash is not None and hash_distance(hashed, last_hash) < dedup_threshold:
+                    continue
+                last_hash = hashed
+            started = time.perf_counter()
+            encoded = profile.encode(frame)
+            encode_seconds += time.perf_counter() - started
+            payload = profile.payload_bytes(encoded)
+            kept += 1
+            full = window_size and len(window.frames) >= window_size
+            full = full or window_bytes + payload > max_window_bytes
+            full = full or (max_window_tokens and (len(window.frames) + 1) * profile.image_tokens > max_window_tokens)
+            if window.frames and full:
+                window.end = int(ts)
+                yield window
+                window, window_bytes = FrameWindow(scene_start, int(ts), profile=profile.name), 0
+            if not window.frames:
+                window.start = int(ts)
+            window.frames.append(encoded)
+            window.timestamps.append(ts)
+            window_bytes += payload
+
+    def close(end):
+        nonlocal window, window_bytes
+        if window.frames:
+            window.end = max(end, int(window.timestamps[-1]) + 1)
+            yield window
+        window, window_bytes = FrameWindow(scene_start, end, profile=profile.name), 0
 
-def reduce_resolution(frames, width = 320, height = 240):
-    reduced_frames = []
-    for frame in frames:
-        reduced_frames.append(cv2.resize(frame, (width, height)))
-    return reduced_frames
+    for event in decode_video(video_path, detector, interval, frame_budget=frame_budget):
+        if event[0] == "frame":
+            sampled += 1
+            started = time.perf_counter()
+            frame = profile.resize(event[2])
+            encode_seconds += time.perf_counter() - started
+            pending.append((event[1], frame, frame_hash(frame) if dedup_threshold else None))
+            # cuts are truncated to whole seconds, so only frames before the current second are final
+            yield from settle(int(event[1]) if detector is not None else float("inf"))
+        elif event[0] == "cut":
+            cut = int(event[1])
+            yield from settle(cut)
+            yield from close(cut)
+            scene_start = cut
+            window.scene_start = scene_start
+            # always keep the first frame of a new scene
+            last_hash = None
+        else:
+            yield from settle(float("inf"))
+            yield from close(int(event[1]))
 
-def base64_encode_frames(frames):
-    encoded_frames = []
+    metrics.add_time("encode", encode_seconds, kept)
+    if dedup_threshold and sampled:
+        logger.info(f"Dedup kept {kept} of {sampled} frames ({1 - kept / sampled:.0%} dropped) for {video_path}")
 
-    for frame in frames:
-        _, buffer = cv2.imencode('.jpg', frame)
-        encoded_frames.append(base64.b64encode(buffer).decode('utf-8'))
+def spill_frame_windows(windows, out_dir: str) -> list:
+    """Writes each window to its own file in `out_dir` and returns the paths, so that
+    a worker process hands back file names instead of pickled frame data."""
+    os.makedirs(out_dir, exist_ok=True)
+    paths = []
+    for i, window in enumerate(windows):
+        path = os.path.join(out_dir, f'{i:05d}.json')
+        with open(path, 'w', encoding='utf-8') as file:
+            json.dump(window.to_dict(), file)
+        paths.append(path)
+    return paths
 
-    return encoded_frames
+def load_frame_windows(paths: list):
+    """Reads windows written by spill_frame_windows one at a time, deleting each file once loaded."""
+    for path in paths:
+        window = FrameWindow.from_dict(read_json_file(path))
+        os.remove(path)
+        yield window
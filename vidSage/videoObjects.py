@@ -11,6 +11,10 @@ class VideoFile:
             "name": self.name
         }
 
+    @staticmethod
+    def from_dict(data: dict):
+        return VideoFile(data["absolutePath"], data["name"])
+
 
 class Segment:
     def __init__(self, startTimeSec: int, endTimeSec: int, description: str, src_file: dict[str, str] = None):
@@ -27,13 +31,19 @@ class Segment:
             "srcFile": self.src_file
         }
 
+    @staticmethod
+    def from_dict(data: dict):
+        return Segment(data["startTimeSec"], data["endTimeSec"], data["description"], data.get("srcFile"))
+
 
 class VideoSummary:
-    def __init__(self, file: VideoFile, summary: str, aesthetic_rating: int, segments: list[Segment]):
+    def __init__(self, file: VideoFile, summary: str, aesthetic_rating: int, segments: list[Segment], complete: bool = True):
         self.file = file
         self.summary = summary
         self.aesthetic_rating = aesthetic_rating
         self.segments = segments
+        # False when an LLM request for it failed; such summaries are not kept for reruns
+        self.complete = complete
 
     def to_dict(self):
         return {
@@ -43,6 +53,40 @@ class VideoSummary:
             "segments": [segment.to_dict() for segment in self.segments]
         }
 
+    @staticmethod
+    def from_dict(data: dict):
+        return VideoSummary(
+            VideoFile.from_dict(data["file"]),
+            data["summary"],
+            data["aestheticRating"],
+            [Segment.from_dict(segment) for segment in data["segments"]]
+        )
+
+class FrameWindow:
+    """A run of consecutive encoded frames from one scene, sent to the LLM in a single request."""
+    def __init__(self, scene_start: int, start: int, end: int = None, frames: list[str] = None, timestamps: list[float] = None, profile: str = 'low'):
+        self.scene_start = scene_start
+        self.start = start
+        self.end = end
+        self.frames = frames if frames is not None else []
+        self.timestamps = timestamps if timestamps is not None else []
+        # name of the EncodeProfile the frames were encoded with
+        self.profile = profile
+
+    def to_dict(self):
+        return {
+            "sceneStart": self.scene_start,
+            "start": self.start,
+            "end": self.end,
+            "frames": self.frames,
+            "timestamps": self.timestamps,
+            "profile": self.profile
+        }
+
+    @staticmethod
+    def from_dict(data: dict):
+        return FrameWindow(data["sceneStart"], data["start"], data["end"], data["frames"], data["timestamps"], data.get("profile", 'low'))
+
 class Scene(BaseModel):
     story: str
     file_path: str
@@ -54,6 +98,9 @@ class Story(BaseModel):
     whole_story: str
     scenes: list[Scene]
 
+class Shortlist(BaseModel):
+    segments: list[int]
+
 class Description(BaseModel):
     description: str
     aestheticRating: int